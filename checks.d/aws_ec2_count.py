@@ -1,7 +1,34 @@
 # -*- coding: utf-8 -*-
-from checks import AgentCheck
 from boto3.session import Session
 from collections import OrderedDict
+import argparse
+import cProfile
+import hashlib
+import json
+import logging
+import os
+import pstats
+import re
+import socket
+import threading
+import time
+
+try:
+    from checks import AgentCheck
+except ImportError:
+    # standalone exporter mode ( python aws_ec2_count.py ) without Datadog Agent
+    AgentCheck = object
+
+try:
+    import tracemalloc
+except ImportError:
+    # tracemalloc is available in Python 3.4 or later
+    tracemalloc = None
+
+try:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
 
 
 class NormalizationFactor():
@@ -29,7 +56,7 @@ class NormalizationFactor():
 
     @classmethod
     def get_sorted_all_sizes(cls):
-        return cls.__nf.keys()
+        return list(cls.__nf.keys())
 
     @classmethod
     def get_value(cls, size):
@@ -169,21 +196,669 @@ class Instances():
             })
         return instances
 
+    def rollup(self):
+        # Instance Family 単位と全体の合計を 1 回の走査で集計する
+        families = {}
+        total    = { 'count' : 0.0, 'footprint' : 0.0 }
+        for az, families_in_az in self.__instances.items():
+            for family, sizes in families_in_az.items():
+                if family not in families:
+                    families[family] = { 'count' : 0.0, 'footprint' : 0.0 }
+                for counter in sizes.values():
+                    count, footprint = counter.get_count(), counter.get_footprint()
+                    families[family]['count']     += count
+                    families[family]['footprint'] += footprint
+                    total['count']     += count
+                    total['footprint'] += footprint
+
+        return families, total
+
+
+class Platform():
+    DEFAULT_PLATFORM = 'Linux/UNIX'
+    DEFAULT_TENANCY  = 'default'
+    UNKNOWN_PLATFORM = 'Unknown'
+
+    @classmethod
+    def get_default_bucket(cls):
+        return (cls.DEFAULT_PLATFORM, cls.DEFAULT_TENANCY)
+
+    @classmethod
+    def from_instance(cls, running_instance):
+        # MEMO: PlatformDetails は boto3 1.18.48 (botocore 1.21.48) 以降でのみ取得できる
+        #       取得できない場合、RHEL・SUSE は Platform も持たず Linux/UNIX と区別できないため、
+        #       Linux/UNIX の RI を消費しないよう Unknown として扱う
+        if 'PlatformDetails' in running_instance:
+            return running_instance['PlatformDetails']
+
+        return cls.UNKNOWN_PLATFORM
+
+    @classmethod
+    def from_product_description(cls, product_description):
+        # 'Linux/UNIX (Amazon VPC)' などは EC2-Classic 用の表記を除いて同一のプラットフォームとして扱う
+        suffix = ' (Amazon VPC)'
+        if product_description.endswith(suffix):
+            return product_description[:-len(suffix)]
+
+        return product_description
+
+    @classmethod
+    def is_size_flexible(cls, platform, tenancy):
+        # Region 指定 RI のサイズ柔軟性は Linux/UNIX かつ default テナンシーにのみ適用される
+        # - http://docs.aws.amazon.com/AWSEC2/latest/UserGuide/apply_ri.html
+        return platform == cls.DEFAULT_PLATFORM and tenancy == cls.DEFAULT_TENANCY
+
+
+class Inventory():
+    # (platform, tenancy) の bucket ごとに Instances を保持する
+    def __init__(self):
+        self.__buckets = {}
+
+    def has(self, platform, tenancy):
+        if (platform, tenancy) in self.__buckets:
+            return True
+
+        return False
+
+    def get(self, platform, tenancy):
+        if not self.has(platform, tenancy):
+            self.__buckets[(platform, tenancy)] = Instances()
+
+        return self.__buckets[(platform, tenancy)]
+
+    def set(self, platform, tenancy, instances):
+        self.__buckets[(platform, tenancy)] = instances
+        return instances
+
+    def get_all_buckets(self):
+        return sorted(self.__buckets.keys())
+
+
+class GroupKeyIndex():
+    # グループキーの値の組み合わせを小さな整数の ID に intern する
+    def __init__(self):
+        self.__ids    = {}
+        self.__values = []
+
+    def get_id(self, values):
+        values = tuple(values)
+        if values not in self.__ids:
+            self.__ids[values] = len(self.__values)
+            self.__values.append(values)
+
+        return self.__ids[values]
+
+    def get_values(self, group_id):
+        return self.__values[group_id]
+
+    def get_size(self):
+        return len(self.__values)
+
+
+class InstanceGroups():
+    # group_by には 'tag:<Key>' / 'vpc' / 'subnet' を指定する
+    NONE_VALUE  = 'none'
+    OTHER_VALUE = 'other'
+    # タグの値が 'none' / 'other' の場合は、集計用の値と区別するため先頭に '_' を付ける
+    # ( Datadog はタグを小文字にするため大文字小文字を区別しない)
+    RESERVED_VALUE = re.compile(r'^_*(none|other)$', re.IGNORECASE)
+
+    def __init__(self, group_by, index=None):
+        self.__group_by = list(group_by)
+        self.__index    = index if index is not None else GroupKeyIndex()
+        self.__counts   = {}
+
+        names = self.get_tag_names()
+        for name in names:
+            if names.count(name) > 1:
+                raise TypeError('duplicate group key : {}'.format(name))
+
+    def get_group_by(self):
+        return self.__group_by
+
+    def get_index(self):
+        return self.__index
+
+    def get_tag_names(self):
+        names = []
+        for key in self.__group_by:
+            if key.startswith('tag:'):
+                # 'aws:autoscaling:groupName' などの ':' はタグの名前と値の区切りになるため '_' に置き換える
+                names.append('ac-tag-{}'.format(key[len('tag:'):].replace(':', '_')))
+            else:
+                names.append('ac-{}'.format(key))
+        return names
+
+    def get_group_values(self, running_instance):
+        tags = {}
+        for tag in running_instance.get('Tags', []):
+            tags[tag['Key']] = tag['Value']
+
+        values = []
+        for key in self.__group_by:
+            value = None
+            if key.startswith('tag:'):
+                value = tags.get(key[len('tag:'):])
+            elif key == 'vpc':
+                value = running_instance.get('VpcId')
+            elif key == 'subnet':
+                value = running_instance.get('SubnetId')
+            else:
+                raise TypeError('unknown group key : {}'.format(key))
+            if not value:
+                value = self.NONE_VALUE
+            elif self.RESERVED_VALUE.match(value):
+                value = '_' + value
+            values.append(value)
+
+        return values
+
+    def add(self, az, itype, running_instance, count=1.0, bucket=None):
+        if bucket is None:
+            bucket = Platform.get_default_bucket()
+        family, size = itype.split('.', 1)
+        group_id = self.__index.get_id(self.get_group_values(running_instance))
+
+        cell = self.__counts.setdefault(bucket, {}).setdefault((az, family, size), {})
+        cell[group_id] = cell.get(group_id, 0.0) + float(count)
+        return group_id
+
+    def breakdown(self, running_instances, ondemand_instances, groups=None, bucket=None):
+        # (az, family, size) ごとのオンデマンド数を、稼働数に占める各グループの割合で按分する
+        if groups is None:
+            groups = {}
+        if bucket is None:
+            bucket = Platform.get_default_bucket()
+        for (az, family, size), cell in self.__counts.get(bucket, {}).items():
+            nf = NormalizationFactor.get_value(size)
+            running_count = running_instances.get(az, family, size).get_count() \
+                if running_instances.has(az, family, size) else 0.0
+            ondemand_count = ondemand_instances.get(az, family, size).get_count() \
+                if ondemand_instances.has(az, family, size) else 0.0
+            ratio = ondemand_count / running_count if running_count > 0.0 else 0.0
+
+            for group_id, count in cell.items():
+                if group_id not in groups:
+                    groups[group_id] = {
+                        'running'  : { 'count' : 0.0, 'footprint' : 0.0 },
+                        'ondemand' : { 'count' : 0.0, 'footprint' : 0.0 },
+                    }
+                group = groups[group_id]
+                group['running']['count']      += count
+                group['running']['footprint']  += count * nf
+                group['ondemand']['count']     += count * ratio
+                group['ondemand']['footprint'] += count * ratio * nf
+
+        return groups
+
+    def dump(self, groups, limit=None):
+        # running の footprint の大きい順に上位 limit 件を出力し、残りは 'other' にまとめる
+        ranked = sorted(groups.keys(), key=lambda group_id: (-groups[group_id]['running']['footprint'], group_id))
+
+        rows = []
+        for group_id in ranked[:limit]:
+            rows.append(self.__dump_group(self.__index.get_values(group_id), groups[group_id]))
+
+        if limit is not None and len(ranked) > limit:
+            other = {
+                'running'  : { 'count' : 0.0, 'footprint' : 0.0 },
+                'ondemand' : { 'count' : 0.0, 'footprint' : 0.0 },
+            }
+            for group_id in ranked[limit:]:
+                for category in other:
+                    for key in other[category]:
+                        other[category][key] += groups[group_id][category][key]
+            rows.append(self.__dump_group([ self.OTHER_VALUE ] * len(self.__group_by), other))
+
+        return rows
+
+    def __dump_group(self, values, group):
+        return {
+            'tags'     : [ '{}:{}'.format(name, value) for name, value in zip(self.get_tag_names(), values) ],
+            'running'  : group['running'],
+            'ondemand' : group['ondemand'],
+        }
+
+
+class CapacityReservationCoverage():
+    # On-Demand Capacity Reservation を、同一 bucket / AZ / Instance Type のオンデマンドに適用する
+    NAME = 'capacity_reservation'
+
+    def __init__(self, reservations):
+        self.__pools   = Inventory()
+        self.__covered = Inventory()
+        for reservation in reservations:
+            self.__pools.get(
+                reservation.get('platform', Platform.DEFAULT_PLATFORM),
+                reservation.get('tenancy',  Platform.DEFAULT_TENANCY),
+            ).get_itype(
+                reservation['az'],
+                reservation['itype'],
+            ).add_count(reservation['count'])
+
+    def get_name(self):
+        return self.NAME
+
+    def cover(self, bucket, az, family, size, counter):
+        if not self.__pools.has(*bucket) or not self.__pools.get(*bucket).has(az, family, size):
+            return
+
+        pool = self.__pools.get(*bucket).get(az, family, size)
+        covered = min(counter.get_count(), pool.get_count())
+        counter.add_count(-covered)
+        pool.add_count(-covered)
+        self.__covered.get(*bucket).get(az, family, size).add_count(covered)
+
+    def get_covered(self):
+        return self.__covered
+
+    def dump_unused(self, all_platforms):
+        # *_covered と同じく、ac-platform / ac-tenancy は all_platforms の場合のみ付ける
+        # all_platforms でない場合は Linux/UNIX ・ default 以外のインスタンスを数えないため、その予約も送らない
+        buckets = self.__pools.get_all_buckets()
+        if not all_platforms:
+            buckets = [ bucket for bucket in buckets if bucket == Platform.get_default_bucket() ]
+
+        rows = []
+        for platform, tenancy in buckets:
+            extra_tags = []
+            if all_platforms:
+                extra_tags = [ 'ac-platform:{}'.format(platform), 'ac-tenancy:{}'.format(tenancy) ]
+            for instance in self.__pools.get(platform, tenancy).dump():
+                rows.append({
+                    'tags' : [
+                        'ac-az:{az}'.format(**instance),
+                        'ac-type:{itype}'.format(**instance),
+                        'ac-family:{family}'.format(**instance),
+                    ] + extra_tags,
+                    'count'     : instance['count'],
+                    'footprint' : instance['footprint'],
+                })
+        return rows
+
+
+class SavingsPlanCoverage():
+    # Savings Plans のコミットメントを footprint 値に換算して適用する
+    # family 指定のもの( EC2 Instance Savings Plans ) を優先し、残りを family 指定なし( Compute Savings Plans ) で適用する
+    NAME = 'savings_plan'
+    ALL_FAMILIES = 'all'
+
+    def __init__(self, commitments):
+        self.__pools   = {}
+        self.__covered = Inventory()
+        for commitment in commitments:
+            family = commitment.get('family', self.ALL_FAMILIES)
+            self.__pools[family] = self.__pools.get(family, 0.0) + float(commitment['footprint'])
+
+    def get_name(self):
+        return self.NAME
+
+    def cover(self, bucket, az, family, size, counter):
+        for pool_family in [ family, self.ALL_FAMILIES ]:
+            if self.__pools.get(pool_family, 0.0) <= 0.0:
+                continue
+
+            covered = min(counter.get_footprint(), self.__pools[pool_family])
+            counter.set_footprint(counter.get_footprint() - covered)
+            self.__pools[pool_family] -= covered
+            covered_counter = self.__covered.get(*bucket).get(az, family, size)
+            covered_counter.set_footprint(covered_counter.get_footprint() + covered)
+
+    def get_covered(self):
+        return self.__covered
+
+    def dump_unused(self, all_platforms):
+        # コミットメントは Instance Type に紐付かず台数として数えられないため、footprint 値のみを返す
+        rows = []
+        for family in sorted(self.__pools.keys()):
+            rows.append({
+                'tags'      : [ 'ac-family:{}'.format(family) ],
+                'footprint' : self.__pools[family],
+            })
+        return rows
+
+
+class CoveragePipeline():
+    # RI の適用後に残ったオンデマンドへ、stages の順にコミットメントを適用する
+    def __init__(self, stages):
+        self.__stages = list(stages)
+
+    @classmethod
+    def load_commitments(cls, path, region=None):
+        with open(path) as f:
+            commitments = json.load(f)
+
+        if region is None:
+            return commitments
+
+        # 1 つのファイルを複数 Region の instance で共有しても同じコミットメントを重複して適用しないよう、
+        # region を指定したものはその Region でのみ、Capacity Reservation は AZ の Region でのみ適用する
+        return {
+            'capacity_reservations' : [
+                reservation for reservation in commitments.get('capacity_reservations', [])
+                if reservation.get('region', region) == region and reservation['az'].startswith(region)
+            ],
+            'savings_plans' : [
+                commitment for commitment in commitments.get('savings_plans', [])
+                if commitment.get('region', region) == region
+            ],
+        }
+
+    def get_stages(self):
+        return self.__stages
+
+    def apply(self, ondemand_instances, bucket=None):
+        # family / size のプールを 1 回だけ走査し、各プールに全 stage を順に適用する
+        if bucket is None:
+            bucket = Platform.get_default_bucket()
+        for instance in ondemand_instances.get_all_instances():
+            counter = instance['counter']
+            for stage in self.__stages:
+                if counter.get_count() <= 0.0:
+                    break
+                stage.cover(bucket, instance['az'], instance['family'], instance['size'], counter)
+
+        return ondemand_instances
+
+
+class CheckProfiler():
+    # profiling 設定のある instance について、every 回に 1 回の実行をプロファイルする
+    __runs = {}
+
+    @classmethod
+    def create(cls, config):
+        profiling = config.get('profiling')
+        if not profiling:
+            return None
+
+        # 同じ Region に複数の instance がある場合も、instance ごとに every 回に 1 回とする
+        key = json.dumps(config, sort_keys=True)
+        cls.__runs[key] = cls.__runs.get(key, 0) + 1
+        if cls.__runs[key] % int(profiling.get('every', 1)) != 0:
+            return None
+
+        return cls(config['region'], profiling, hashlib.sha1(key.encode('utf-8')).hexdigest()[:8])
+
+    def __init__(self, region, profiling, instance_id=None):
+        self.__region          = region
+        self.__instance_id     = instance_id
+        self.__directory       = profiling['directory']
+        self.__use_tracemalloc = profiling.get('tracemalloc', True) and tracemalloc is not None
+        self.__own_tracemalloc = False
+        self.__top_allocations = int(profiling.get('top_allocations', 20))
+        self.__fleet_size      = 0
+        self.__stages          = []
+        self.__profile         = None
+        self.__started_at      = None
+        self.__marked_at       = None
+
+    def start(self):
+        # PYTHONTRACEMALLOC などで既に開始されている場合は、その計測を止めないよう開始・停止しない
+        if self.__use_tracemalloc and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self.__own_tracemalloc = True
+        self.__profile = cProfile.Profile()
+        self.__started_at = self.__marked_at = time.time()
+        self.__profile.enable()
+
+    def mark(self, stage):
+        # 前回の mark からの経過時間を stage の所要時間として記録する
+        now = time.time()
+        self.__stages.append((stage, now - self.__marked_at))
+        self.__marked_at = now
+
+    def set_fleet_size(self, fleet_size):
+        self.__fleet_size = int(fleet_size)
+
+    def get_stages(self):
+        return self.__stages
+
+    def stop(self):
+        self.__profile.disable()
+        elapsed = time.time() - self.__started_at
+
+        allocations = []
+        if self.__use_tracemalloc:
+            try:
+                allocations = tracemalloc.take_snapshot().statistics('lineno')[:self.__top_allocations]
+            finally:
+                if self.__own_tracemalloc:
+                    tracemalloc.stop()
+                    self.__own_tracemalloc = False
+
+        try:
+            os.makedirs(self.__directory)
+        except OSError:
+            # 他の instance が同時に作成した場合も含め、既に存在すればそのまま使う
+            if not os.path.isdir(self.__directory):
+                raise
+        # 同じ Region の instance が同時にプロファイルされても上書きしないよう、instance の設定のハッシュを含める
+        base = os.path.join(self.__directory, 'aws_ec2_count-{}-{}-{}-n{}'.format(
+            self.__region if self.__instance_id is None else '{}-{}'.format(self.__region, self.__instance_id),
+            time.strftime('%Y%m%dT%H%M%S', time.localtime(self.__started_at)),
+            os.getpid(),
+            self.__fleet_size,
+        ))
+
+        self.__profile.dump_stats(base + '.prof')
+        with open(base + '.txt', 'w') as f:
+            f.write('region     : {}\n'.format(self.__region))
+            f.write('fleet size : {}\n'.format(self.__fleet_size))
+            f.write('elapsed    : {:.3f}s\n'.format(elapsed))
+            for stage, seconds in self.__stages:
+                f.write('stage      : {} = {:.3f}s\n'.format(stage, seconds))
+
+            if allocations:
+                f.write('\ntop allocations\n')
+                for statistic in allocations:
+                    f.write('{}\n'.format(statistic))
+
+            f.write('\n')
+            stats = pstats.Stats(self.__profile, stream=f)
+            stats.sort_stats('cumulative').print_stats(30)
+
+        return [ base + '.prof', base + '.txt' ]
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class CircuitBreaker():
+    # Region と API ごとに、連続して失敗した API の呼び出しを cooldown 秒間停止する
+    # cooldown 経過後は 1 回だけ試行( half-open ) し、成功すれば再開、失敗すれば再び停止する
+    CLOSED    = 'closed'
+    OPEN      = 'open'
+    HALF_OPEN = 'half-open'
+
+    __lock     = threading.Lock()
+    __breakers = {}
+
+    @classmethod
+    def get(cls, region, operation, failure_threshold=3, cooldown=300):
+        # failure_threshold・cooldown の異なる instance は別の breaker を使う
+        key = (region, operation, int(failure_threshold), float(cooldown))
+        with cls.__lock:
+            if key not in cls.__breakers:
+                cls.__breakers[key] = cls(failure_threshold, cooldown)
+
+            return cls.__breakers[key]
+
+    def __init__(self, failure_threshold=3, cooldown=300, clock=time.time):
+        self.__failure_threshold = int(failure_threshold)
+        self.__cooldown          = float(cooldown)
+        self.__clock             = clock
+        self.__state             = self.CLOSED
+        self.__failures          = 0
+        self.__opened_at         = None
+        # 並行して実行される instance から、複数の呼び出しが half-open の試行にならないよう状態の変更を排他する
+        self.__lock              = threading.Lock()
+
+    def get_state(self):
+        return self.__state
+
+    def allow(self):
+        with self.__lock:
+            if self.__state == self.CLOSED:
+                return True
+            if self.__state == self.OPEN and self.__clock() - self.__opened_at >= self.__cooldown:
+                self.__state = self.HALF_OPEN
+                return True
+
+            return False
+
+    def record_success(self):
+        with self.__lock:
+            self.__state    = self.CLOSED
+            self.__failures = 0
+
+    def record_failure(self):
+        with self.__lock:
+            self.__failures += 1
+            if self.__state == self.HALF_OPEN or self.__failures >= self.__failure_threshold:
+                self.__state     = self.OPEN
+                self.__opened_at = self.__clock()
+
+
+class PendingRequest():
+    def __init__(self):
+        self.event  = threading.Event()
+        self.result = None
+        self.error  = None
+
+
+class RequestCache():
+    # 同一プロセス内で、同じ key ( region / account / API / 引数 ) の呼び出し結果を ttl 秒間共有する
+    # 同じ key の呼び出しが実行中であれば、新たに呼び出さずにその結果を待つ
+    __lock    = threading.Lock()
+    __entries = {}
+    __pending = {}
+
+    @classmethod
+    def get(cls, key, ttl, fetch):
+        with cls.__lock:
+            entry = cls.__entries.get(key)
+            if entry is not None and entry[0] > time.time():
+                return entry[1]
+
+            request = cls.__pending.get(key)
+            owner = request is None
+            if owner:
+                request = cls.__pending[key] = PendingRequest()
+
+        if not owner:
+            request.event.wait()
+            if request.error is not None:
+                raise request.error
+            return request.result
+
+        # MEMO: KeyboardInterrupt などの BaseException でも、結果のない呼び出しをキャッシュしない
+        succeeded = False
+        try:
+            request.result = fetch()
+            succeeded = True
+        except BaseException as e:
+            request.error = e
+            raise
+        finally:
+            with cls.__lock:
+                del cls.__pending[key]
+                if succeeded:
+                    now = time.time()
+                    for expired in [ k for k, v in cls.__entries.items() if v[0] <= now ]:
+                        del cls.__entries[expired]
+                    cls.__entries[key] = (now + ttl, request.result)
+            request.event.set()
+
+        return request.result
+
+    @classmethod
+    def clear(cls):
+        with cls.__lock:
+            cls.__entries.clear()
+
 
 class InstanceFetcher():
-    def __init__(self, region):
+    def __init__(self, region, circuit_breaker=None, cache_ttl=0):
         session = Session(region_name=region)
-        self.__ec2 = session.client('ec2')
-
-    def get_running_instances(self):
+        self.__ec2             = session.client('ec2')
+        self.__region          = region
+        self.__circuit_breaker = circuit_breaker
+        self.__cache_ttl       = float(cache_ttl)
+        self.__account         = None
+        if self.__cache_ttl > 0:
+            # MEMO: 異なる認証情報( AWS アカウント) の結果を共有しないよう、アクセスキーを key に含める
+            credentials = session.get_credentials()
+            if credentials is not None:
+                self.__account = credentials.access_key
+
+    def __call(self, operation, **kwargs):
+        if self.__cache_ttl <= 0:
+            return self.__call_api(operation, kwargs)
+
+        key = (self.__region, self.__account, operation, json.dumps(kwargs, sort_keys=True))
+        return RequestCache.get(key, self.__cache_ttl, lambda: self.__call_api(operation, kwargs))
+
+    def __call_api(self, operation, kwargs):
+        if self.__circuit_breaker is None:
+            return getattr(self.__ec2, operation)(**kwargs)
+
+        breaker = CircuitBreaker.get(self.__region, operation, **self.__circuit_breaker)
+        if not breaker.allow():
+            raise CircuitOpenError('circuit open : {} {}'.format(self.__region, operation))
+
+        # half-open の試行が KeyboardInterrupt などで中断されても half-open のまま残らないよう、 BaseException も失敗として扱う
+        try:
+            result = getattr(self.__ec2, operation)(**kwargs)
+        except BaseException:
+            breaker.record_failure()
+            raise
+
+        breaker.record_success()
+        return result
+
+    def get_running_instances(self, groups=None):
         instances = Instances()
+        filters = [
+            { 'Name' : 'instance-state-name', 'Values' : [ 'running' ] },
+            { 'Name' : 'tenancy',             'Values' : [ 'default' ] },
+        ]
+        for running_instance in self.__describe_running_instances(filters):
+            # exclude not 'Linux/UNIX' Platform
+            if 'Platform' in running_instance:
+                continue
+
+            az, itype = running_instance['Placement']['AvailabilityZone'], running_instance['InstanceType']
+            instances.get_itype(az, itype).incr_count()
+            if groups is not None:
+                groups.add(az, itype, running_instance)
+
+        return instances
+
+    def get_running_inventory(self, groups=None):
+        # プラットフォーム・テナンシーで絞り込まず、1 回の走査で bucket ごとに振り分ける
+        inventory = Inventory()
+        filters = [
+            { 'Name' : 'instance-state-name', 'Values' : [ 'running' ] },
+        ]
+        for running_instance in self.__describe_running_instances(filters):
+            bucket = (
+                Platform.from_instance(running_instance),
+                running_instance['Placement'].get('Tenancy', Platform.DEFAULT_TENANCY),
+            )
+            az, itype = running_instance['Placement']['AvailabilityZone'], running_instance['InstanceType']
+            inventory.get(*bucket).get_itype(az, itype).incr_count()
+            if groups is not None:
+                groups.add(az, itype, running_instance, bucket=bucket)
+
+        return inventory
+
+    def __describe_running_instances(self, filters):
         next_token = ''
         while True:
-            running_instances = self.__ec2.describe_instances(
-                Filters=[
-                    { 'Name' : 'instance-state-name', 'Values' : [ 'running' ] },
-                    { 'Name' : 'tenancy',             'Values' : [ 'default' ] },
-                ],
+            running_instances = self.__call(
+                'describe_instances',
+                Filters=filters,
                 MaxResults=100,
                 NextToken=next_token,
             )
@@ -193,36 +868,53 @@ class InstanceFetcher():
                     # exclude SpotInstance
                     if 'SpotInstanceRequestId' in running_instance:
                         continue
-                    # exclude not 'Linux/UNIX' Platform
-                    if 'Platform' in running_instance:
-                        continue
 
-                    instances.get_itype(
-                        running_instance['Placement']['AvailabilityZone'],
-                        running_instance['InstanceType'],
-                    ).incr_count()
+                    yield running_instance
 
             if 'NextToken' in running_instances:
                 next_token = running_instances['NextToken']
             else:
                 break
 
-        return instances
-
     def get_reserved_instances(self):
         instances = Instances()
+        filters = [
+            { 'Name' : 'state',               'Values' : [ 'active' ] },
+            { 'Name' : 'product-description', 'Values' : [ 'Linux/UNIX', 'Linux/UNIX (Amazon VPC)' ] },
+            { 'Name' : 'instance-tenancy',    'Values' : [ 'default' ] },
+        ]
+        if not self.__collect_reserved_instances(filters, lambda reserved_instance: instances):
+            return None
 
-        reserved_instances = self.__ec2.describe_reserved_instances(
-            Filters=[
-                { 'Name' : 'state',               'Values' : [ 'active' ] },
-                { 'Name' : 'product-description', 'Values' : [ 'Linux/UNIX', 'Linux/UNIX (Amazon VPC)' ] },
-                { 'Name' : 'instance-tenancy',    'Values' : [ 'default' ] },
-            ],
+        return instances
+
+    def get_reserved_inventory(self):
+        inventory = Inventory()
+        filters = [
+            { 'Name' : 'state', 'Values' : [ 'active' ] },
+        ]
+        collected = self.__collect_reserved_instances(
+            filters,
+            lambda reserved_instance: inventory.get(
+                Platform.from_product_description(reserved_instance['ProductDescription']),
+                reserved_instance['InstanceTenancy'],
+            ),
+        )
+        if not collected:
+            return None
+
+        return inventory
+
+    def __collect_reserved_instances(self, filters, get_instances):
+        reserved_instances = self.__call(
+            'describe_reserved_instances',
+            Filters=filters,
         )
 
         for reserved_instance in reserved_instances['ReservedInstances']:
             # exclude processing status
-            modify_requests = self.__ec2.describe_reserved_instances_modifications(
+            modify_requests = self.__call(
+                'describe_reserved_instances_modifications',
                 Filters=[
                     { 'Name' : 'status',                'Values' : [ 'processing' ] },
                     { 'Name' : 'reserved-instances-id', 'Values' : [ reserved_instance['ReservedInstancesId'] ] },
@@ -235,7 +927,7 @@ class InstanceFetcher():
                             # MEMO: RI 契約が変更中( status = processing ) かつ、
                             #       変更先の RI 契約が確定していない場合、
                             #       RI の集計にずれが発生するタイミングがあるので、RI の集計はしない
-                            return None
+                            return False
 
                 # MEMO: RI 契約が変更中かつ、変更先の RI 契約が確定している場合
                 #       変更元の RI を集計すると2重計上になるので集計から外す
@@ -247,14 +939,43 @@ class InstanceFetcher():
             else:
                 az = reserved_instance['AvailabilityZone']
 
-            instances.get_itype(
+            get_instances(reserved_instance).get_itype(
                 az,
                 reserved_instance['InstanceType'],
             ).add_count(reserved_instance['InstanceCount'])
 
-        return instances
+        return True
 
-    def get_ondemand_instances(self, running_instances, reserved_instances):
+    def get_capacity_reservations(self):
+        reservations = []
+        next_token = ''
+        while True:
+            capacity_reservations = self.__call(
+                'describe_capacity_reservations',
+                Filters=[
+                    { 'Name' : 'state', 'Values' : [ 'active' ] },
+                ],
+                MaxResults=100,
+                NextToken=next_token,
+            )
+
+            for capacity_reservation in capacity_reservations['CapacityReservations']:
+                reservations.append({
+                    'platform' : Platform.from_product_description(capacity_reservation['InstancePlatform']),
+                    'tenancy'  : capacity_reservation['Tenancy'],
+                    'az'       : capacity_reservation['AvailabilityZone'],
+                    'itype'    : capacity_reservation['InstanceType'],
+                    'count'    : capacity_reservation['TotalInstanceCount'],
+                })
+
+            if 'NextToken' in capacity_reservations:
+                next_token = capacity_reservations['NextToken']
+            else:
+                break
+
+        return reservations
+
+    def get_ondemand_instances(self, running_instances, reserved_instances, size_flexible=True):
         # 稼働中インスタンス(running_instances) と契約中のRI(reserved_instances) から
         # オンデマンドインスタンス(ondemand_instances) と余剰RI(unused_instances) を計算する
         ondemand_instances = Instances()
@@ -292,6 +1013,9 @@ class InstanceFetcher():
             ondemand_instances.get(az, family, size).set_count(count)
 
         # 余剰 Region 指定 RI を、同一 Instance Family で最小の Instance Size から適用する
+        if not size_flexible:
+            return ondemand_instances, unused_instances
+
         for unused in unused_instances.get_all_instances(az='region'):
             family, size = unused['family'], unused['size']
             if unused['counter'].get_footprint() == 0.0:
@@ -312,39 +1036,391 @@ class InstanceFetcher():
 
         return ondemand_instances, unused_instances
 
+    def get_ondemand_inventory(self, running_inventory, reserved_inventory):
+        # bucket ごとに、その bucket に適用されるサイズ柔軟性のルールで独立して RI を適用する
+        ondemand_inventory = Inventory()
+        unused_inventory   = Inventory()
+
+        buckets = set(running_inventory.get_all_buckets()) | set(reserved_inventory.get_all_buckets())
+        for platform, tenancy in sorted(buckets):
+            running_instances  = running_inventory.get(platform, tenancy) \
+                if running_inventory.has(platform, tenancy) else Instances()
+            reserved_instances = reserved_inventory.get(platform, tenancy) \
+                if reserved_inventory.has(platform, tenancy) else Instances()
+
+            ondemand_instances, unused_instances = self.get_ondemand_instances(
+                running_instances,
+                reserved_instances,
+                size_flexible=Platform.is_size_flexible(platform, tenancy),
+            )
+            ondemand_inventory.set(platform, tenancy, ondemand_instances)
+            unused_inventory.set(platform, tenancy, unused_instances)
+
+        return ondemand_inventory, unused_inventory
+
+
+class DogStatsdSink():
+    # Datadog Agent の aggregator を経由せず DogStatsD に gauge を送信する
+    # 1 つのデータグラムに収まるだけのメトリクスをまとめ、メトリクス名とタグはエンコード済みのものを再利用する
+    UDP_MAX_PACKET_SIZE = 1432
+    UDS_MAX_PACKET_SIZE = 8192
+
+    __sinks = {}
+    __sinks_lock = threading.Lock()
+
+    @classmethod
+    def get(cls, host='127.0.0.1', port=8125, socket_path=None, max_packet_size=None):
+        key = (host, port, socket_path, max_packet_size)
+        with cls.__sinks_lock:
+            if key not in cls.__sinks:
+                cls.__sinks[key] = cls(host, port, socket_path, max_packet_size)
+
+            return cls.__sinks[key]
+
+    def __init__(self, host='127.0.0.1', port=8125, socket_path=None, max_packet_size=None):
+        if socket_path is not None:
+            self.__socket  = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            self.__address = socket_path
+            default_packet_size = self.UDS_MAX_PACKET_SIZE
+        else:
+            self.__socket  = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            self.__address = (host, int(port))
+            default_packet_size = self.UDP_MAX_PACKET_SIZE
+        self.__max_packet_size = int(max_packet_size or default_packet_size)
+
+        self.__names   = {}
+        self.__tags    = {}
+        self.__lines   = []
+        self.__size    = 0
+        self.__dropped = 0
+        self.__lock    = threading.Lock()
+
+    def get_dropped(self):
+        return self.__dropped
+
+    def close(self):
+        self.flush()
+        self.__socket.close()
+
+    def gauge(self, metric, value, tags=None):
+        name = self.__names.get(metric)
+        if name is None:
+            name = self.__names[metric] = metric.encode('utf-8') + b':'
+
+        tags = tuple(tags or [])
+        encoded_tags = self.__tags.get(tags)
+        if encoded_tags is None:
+            encoded_tags = self.__tags[tags] = (b'|g|#' + ','.join(tags).encode('utf-8')) if tags else b'|g'
+
+        line = name + repr(float(value)).encode('ascii') + encoded_tags
+        with self.__lock:
+            if self.__lines and self.__size + 1 + len(line) > self.__max_packet_size:
+                self.__send()
+            self.__size += len(line) + (1 if self.__lines else 0)
+            self.__lines.append(line)
+
+    def flush(self):
+        with self.__lock:
+            if self.__lines:
+                self.__send()
+
+    def __send(self):
+        packet = b'\n'.join(self.__lines)
+        self.__lines = []
+        self.__size  = 0
+        try:
+            self.__socket.sendto(packet, self.__address)
+        except socket.error:
+            self.__dropped += 1
+
 
 class AwsEc2Count(AgentCheck):
+    AGGREGATION_LEVELS = [ 'az', 'family', 'region' ]
+
+    # instance の設定ごとに、最後に正常に計算できたメトリクス ( 時刻, [ ( metric, value, tags ), ... ] )
+    __last_payloads = {}
+
     def check(self, config):
         if 'region' not in config:
             self.log.error('no region')
             return
 
-        fetcher = InstanceFetcher(config['region'])
+        # false で無効、 true や値なしはデフォルト設定で有効
+        circuit_breaker = config.get('circuit_breaker')
+        if circuit_breaker is False:
+            circuit_breaker = None
+        elif circuit_breaker is True or not circuit_breaker:
+            circuit_breaker = {}
+        fetcher = InstanceFetcher(config['region'], circuit_breaker, config.get('request_cache_ttl', 0))
+
+        groups = None
+        if 'group_by' in config:
+            groups = InstanceGroups(config['group_by'])
+
+        self.__payload = []
+        try:
+            completed = self.__check_with_profiler(fetcher, groups, config)
+        except Exception as e:
+            if not self.__send_stale_payload(config, e):
+                raise
+            return
 
-        reserved_instances = fetcher.get_reserved_instances()
-        if reserved_instances is None:
+        if completed:
+            self.__last_payloads[self.__get_payload_key(config)] = (time.time(), self.__payload)
+        self.__flush_payload(self.__payload, config)
+
+    def __check_with_profiler(self, fetcher, groups, config):
+        profiler = CheckProfiler.create(config)
+        if profiler is None:
+            return self.__check_instances(fetcher, groups, config, None)
+
+        profiler.start()
+        try:
+            return self.__check_instances(fetcher, groups, config, profiler)
+        finally:
+            # MEMO: プロファイルの書き出しに失敗しても check の結果には影響させない
+            try:
+                for path in profiler.stop():
+                    self.log.info('profile : {}'.format(path))
+            except Exception as e:
+                self.log.warning('failed to write profile : {}'.format(e))
+
+    def __get_payload_key(self, config):
+        return json.dumps(config, sort_keys=True)
+
+    def __send_stale_payload(self, config, error):
+        key = self.__get_payload_key(config)
+        if key not in self.__last_payloads:
+            return False
+
+        computed_at, payload = self.__last_payloads[key]
+        age = time.time() - computed_at
+        self.log.warning('send stale metrics computed {:.0f}s ago : {}'.format(age, error))
+        prefix = self.init_config.get('metrics_prefix', 'aws_ec2_count')
+        stale_payload = [ (metric, value, tags + [ 'ac-stale:true' ]) for metric, value, tags in payload ]
+        stale_payload.append((prefix + '.stale_age', age, [ 'ac-region:{}'.format(config['region']) ]))
+        self.__flush_payload(stale_payload, config)
+        return True
+
+    def __flush_payload(self, payload, config):
+        if not config.get('dogstatsd'):
+            for metric, value, tags in payload:
+                self.gauge(metric, value, tags=tags)
             return
-        self.__send_instance_info('reserved', reserved_instances)
 
-        running_instances = fetcher.get_running_instances()
-        self.__send_instance_info('running', running_instances)
+        for destination in config['dogstatsd']:
+            sink = DogStatsdSink.get(**destination)
+            for metric, value, tags in payload:
+                sink.gauge(metric, value, tags)
+            sink.flush()
 
-        ondemand_instances, unused_instances = fetcher.get_ondemand_instances(running_instances, reserved_instances)
-        self.__send_instance_info('ondemand', ondemand_instances)
-        self.__send_instance_info('reserved_unused', unused_instances)
+    def __check_instances(self, fetcher, groups, config, profiler):
+        for level in config.get('aggregation_levels', [ 'az' ]):
+            if level not in self.AGGREGATION_LEVELS:
+                raise TypeError('unknown aggregation level : {}'.format(level))
 
-    def __send_instance_info(self, category, instances):
-        self.log.info(category)
-        for instance in instances.dump():
-            self.log.info('{az} : {itype} = {count} ({footprint})'.format(**instance))
-            self.__send_count(category, instance)
+        if config.get('all_platforms', False):
+            return self.__check_all_platforms(fetcher, groups, config, profiler)
 
-    def __send_count(self, category, instance):
+        # MEMO: プロファイルの各段階が all_platforms と同じ処理を計測するよう、送信は計算の後にまとめて行う
+        reserved_instances = fetcher.get_reserved_instances()
+        if reserved_instances is None:
+            return False
+        if profiler is not None:
+            profiler.mark('reserved')
+
+        running_instances = fetcher.get_running_instances(groups)
+        if profiler is not None:
+            profiler.mark('running')
+            profiler.set_fleet_size(running_instances.rollup()[1]['count'])
+
+        ondemand_instances, unused_instances = fetcher.get_ondemand_instances(running_instances, reserved_instances)
+        pipeline = self.__get_coverage_pipeline(fetcher, config)
+        if pipeline is not None:
+            pipeline.apply(ondemand_instances)
+        if profiler is not None:
+            profiler.mark('ondemand')
+
+        self.__send_instance_info('reserved', reserved_instances, config)
+        self.__send_instance_info('running', running_instances, config)
+        self.__send_instance_info('ondemand', ondemand_instances, config)
+        self.__send_instance_info('reserved_unused', unused_instances, config)
+
+        if pipeline is not None:
+            self.__send_coverage_info(pipeline, config, False)
+
+        if groups is not None:
+            self.__send_group_info(groups, groups.breakdown(running_instances, ondemand_instances), config)
+        if profiler is not None:
+            profiler.mark('send')
+
+        return True
+
+    def __check_all_platforms(self, fetcher, groups, config, profiler):
+        reserved_inventory = fetcher.get_reserved_inventory()
+        if reserved_inventory is None:
+            return False
+        if profiler is not None:
+            profiler.mark('reserved')
+
+        running_inventory = fetcher.get_running_inventory(groups)
+        unknown = sum(
+            running_inventory.get(platform, tenancy).rollup()[1]['count']
+            for platform, tenancy in running_inventory.get_all_buckets() if platform == Platform.UNKNOWN_PLATFORM
+        )
+        if unknown > 0:
+            self.log.warning('{:.0f} running instances have no PlatformDetails and are counted as {} (boto3 1.18.48 or later is required)'.format(
+                unknown, Platform.UNKNOWN_PLATFORM,
+            ))
+        if profiler is not None:
+            profiler.mark('running')
+            profiler.set_fleet_size(sum(
+                running_inventory.get(*bucket).rollup()[1]['count'] for bucket in running_inventory.get_all_buckets()
+            ))
+
+        ondemand_inventory, unused_inventory = fetcher.get_ondemand_inventory(running_inventory, reserved_inventory)
+        pipeline = self.__get_coverage_pipeline(fetcher, config)
+        if pipeline is not None:
+            for bucket in ondemand_inventory.get_all_buckets():
+                pipeline.apply(ondemand_inventory.get(*bucket), bucket)
+        if profiler is not None:
+            profiler.mark('ondemand')
+
+        for category, inventory in [
+            ( 'reserved',        reserved_inventory ),
+            ( 'running',         running_inventory ),
+            ( 'ondemand',        ondemand_inventory ),
+            ( 'reserved_unused', unused_inventory ),
+        ]:
+            self.__send_inventory_info(category, inventory, config, True)
+
+        if pipeline is not None:
+            self.__send_coverage_info(pipeline, config, True)
+
+        if groups is not None:
+            breakdown = {}
+            for platform, tenancy in running_inventory.get_all_buckets():
+                groups.breakdown(
+                    running_inventory.get(platform, tenancy),
+                    ondemand_inventory.get(platform, tenancy),
+                    breakdown,
+                    bucket=(platform, tenancy),
+                )
+            self.__send_group_info(groups, breakdown, config)
+        if profiler is not None:
+            profiler.mark('send')
+
+        return True
+
+    def __get_coverage_pipeline(self, fetcher, config):
+        if not config.get('coverage'):
+            return None
+
+        commitments = {}
+        if 'commitment_file' in config:
+            commitments = CoveragePipeline.load_commitments(config['commitment_file'], config['region'])
+
+        stages = []
+        for name in config['coverage']:
+            if name == CapacityReservationCoverage.NAME:
+                stages.append(CapacityReservationCoverage(
+                    fetcher.get_capacity_reservations() + commitments.get('capacity_reservations', [])
+                ))
+            elif name == SavingsPlanCoverage.NAME:
+                stages.append(SavingsPlanCoverage(commitments.get('savings_plans', [])))
+            else:
+                raise TypeError('unknown coverage : {}'.format(name))
+
+        return CoveragePipeline(stages)
+
+    def __send_coverage_info(self, pipeline, config, all_platforms):
+        for stage in pipeline.get_stages():
+            self.__send_inventory_info('{}_covered'.format(stage.get_name()), stage.get_covered(), config, all_platforms)
+
+            self.log.info('{}_unused'.format(stage.get_name()))
+            for unused in stage.dump_unused(all_platforms):
+                if 'count' not in unused:
+                    # AZ に紐付かないため、複数の instance で上書きし合わないよう ac-region を付ける
+                    self.log.info('{} = ({})'.format(','.join(unused['tags']), unused['footprint']))
+                    self.__send_gauge(
+                        '{}_unused.footprint'.format(stage.get_name()),
+                        unused['footprint'],
+                        [ 'ac-region:{}'.format(config['region']) ] + unused['tags'],
+                    )
+                    continue
+
+                self.log.info('{} = {} ({})'.format(','.join(unused['tags']), unused['count'], unused['footprint']))
+                self.__send_rollup('{}_unused'.format(stage.get_name()), unused, unused['tags'])
+
+    def __send_instance_info(self, category, instances, config, extra_tags=None):
+        self.__send_buckets_info(category, [ ( instances, extra_tags or [] ) ], config)
+
+    def __send_inventory_info(self, category, inventory, config, all_platforms):
+        buckets = []
+        for platform, tenancy in inventory.get_all_buckets():
+            extra_tags = []
+            if all_platforms:
+                extra_tags = [ 'ac-platform:{}'.format(platform), 'ac-tenancy:{}'.format(tenancy) ]
+            buckets.append(( inventory.get(platform, tenancy), extra_tags ))
+        self.__send_buckets_info(category, buckets, config)
+
+    def __send_buckets_info(self, category, buckets, config):
+        levels = config.get('aggregation_levels', [ 'az' ])
+        # max_az_series は platform・tenancy の bucket をまたいで category ごとに適用する
+        dumps = [ instances.dump() for instances, extra_tags in buckets ]
+        selected = self.__limit_series(dumps, config.get('max_az_series'))
+
+        for index, ( instances, extra_tags ) in enumerate(buckets):
+            self.log.info(' '.join([ category ] + extra_tags))
+            for instance in dumps[index]:
+                self.log.info('{az} : {itype} = {count} ({footprint})'.format(**instance))
+
+            if 'az' in levels:
+                for position, instance in enumerate(dumps[index]):
+                    if selected is None or (index, position) in selected:
+                        self.__send_count(category, instance, extra_tags)
+
+            if 'family' in levels or 'region' in levels:
+                families, total = instances.rollup()
+                region_tag = 'ac-region:{}'.format(config['region'])
+                if 'family' in levels:
+                    for family in sorted(families.keys()):
+                        self.__send_rollup(
+                            '{}.family'.format(category),
+                            families[family],
+                            [ region_tag, 'ac-family:{}'.format(family) ] + extra_tags,
+                        )
+                if 'region' in levels:
+                    self.__send_rollup('{}.region'.format(category), total, [ region_tag ] + extra_tags)
+
+    def __send_group_info(self, groups, breakdown, config):
+        self.log.info('group')
+        for group in groups.dump(breakdown, config.get('group_limit')):
+            self.log.info('{} : running = {} ({}), ondemand = {} ({})'.format(
+                ','.join(group['tags']),
+                group['running']['count'],  group['running']['footprint'],
+                group['ondemand']['count'], group['ondemand']['footprint'],
+            ))
+            # 複数の instance で同じグループの metric context を上書きし合わないよう ac-region を付ける
+            tags = [ 'ac-region:{}'.format(config['region']) ] + group['tags']
+            self.__send_rollup('running.group',  group['running'],  tags)
+            self.__send_rollup('ondemand.group', group['ondemand'], tags)
+
+    def __limit_series(self, dumps, limit):
+        # footprint の大きい順に上位 limit 件の ( bucket, 位置 ) を返す (制限しない場合は None)
+        positions = [ (index, position) for index, dump in enumerate(dumps) for position in range(len(dump)) ]
+        if limit is None or len(positions) <= limit:
+            return None
+
+        ranked = sorted(positions, key=lambda p: dumps[p[0]][p[1]]['footprint'], reverse=True)
+        return set(ranked[:limit])
+
+    def __send_count(self, category, instance, extra_tags=None):
         tags = [
             'ac-az:{az}'.format(**instance),
             'ac-type:{itype}'.format(**instance),
             'ac-family:{family}'.format(**instance),
-        ]
+        ] + (extra_tags or [])
         self.__send_gauge(
             '{}.count'.format(category),
             instance['count'],
@@ -356,10 +1432,135 @@ class AwsEc2Count(AgentCheck):
             tags,
         )
 
+    def __send_rollup(self, metric, rollup, tags):
+        self.__send_gauge('{}.count'.format(metric),     rollup['count'],     tags)
+        self.__send_gauge('{}.footprint'.format(metric), rollup['footprint'], tags)
+
     def __send_gauge(self, metric, value, tags):
         prefix = self.init_config.get('metrics_prefix', 'aws_ec2_count')
-        self.gauge(
+        self.__payload.append((
             prefix + '.' + metric,
             value,
-            tags=tags
-        )
+            tags,
+        ))
+
+
+class MetricsExporter(AwsEc2Count):
+    # Datadog Agent を使わずに AwsEc2Count のチェックを定期的に実行し、
+    # 計算済みのメトリクスを Prometheus のテキスト形式で HTTP から返す
+    def __init__(self, init_config, instances, log=None):
+        self.init_config = init_config or {}
+        self.instances   = instances or []
+        self.log         = log if log is not None else logging.getLogger('aws_ec2_count')
+        self.__buffer    = []
+        self.__body      = b''
+        self.__region    = None
+
+    def gauge(self, metric, value, tags=None):
+        # 複数 Region の instance を 1 つの exposition にまとめるため、すべての sample に ac-region を付ける
+        # ( Region 指定 RI の ac-az:region などが Region 間で同じラベルにならないようにする)
+        tags = list(tags or [])
+        if self.__region is not None and not any(tag.startswith('ac-region:') for tag in tags):
+            tags.append('ac-region:{}'.format(self.__region))
+        self.__buffer.append((metric, value, tags))
+
+    def refresh(self):
+        self.__buffer = []
+        for instance in self.instances:
+            self.__region = instance.get('region')
+            try:
+                self.check(instance)
+            except Exception:
+                self.log.exception('check failed : {}'.format(instance.get('region')))
+            finally:
+                self.__region = None
+
+        # MEMO: scrape 時にはメモリ上のレスポンスを返すだけにするため、ここで描画まで済ませておく
+        self.__body = self.render(self.__buffer, self.log)
+        return self.__body
+
+    def get_body(self):
+        return self.__body
+
+    @classmethod
+    def render(cls, payload, log=None):
+        metrics = OrderedDict()
+        for metric, value, tags in payload:
+            name = re.sub(r'[^a-zA-Z0-9_:]', '_', metric)
+            labels = []
+            for tag in tags:
+                key, _, label_value = tag.partition(':')
+                label_value = label_value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+                labels.append('{}="{}"'.format(re.sub(r'[^a-zA-Z0-9_]', '_', key), label_value))
+            samples = metrics.setdefault(name, OrderedDict())
+            label_set = ','.join(labels)
+            # Prometheus は同じラベルの sample を破棄するため、重複した sample は最初のものだけを返す
+            if label_set in samples:
+                if log is not None:
+                    log.warning('duplicate sample dropped : {}{{{}}}'.format(name, label_set))
+                continue
+            samples[label_set] = value
+
+        lines = []
+        for name, samples in metrics.items():
+            lines.append('# TYPE {} gauge'.format(name))
+            for label_set, value in samples.items():
+                lines.append('{}{{{}}} {}'.format(name, label_set, repr(float(value))))
+
+        return ('\n'.join(lines) + '\n').encode('utf-8')
+
+    def run(self, interval):
+        while True:
+            time.sleep(interval)
+            self.refresh()
+
+    def serve(self, host, port):
+        server = HTTPServer((host, port), MetricsRequestHandler)
+        server.exporter = self
+        return server
+
+
+class MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path != '/metrics':
+            self.send_error(404)
+            return
+
+        body = self.server.exporter.get_body()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        self.server.exporter.log.debug(format % args)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='export AWS EC2 instance counts without Datadog Agent')
+    parser.add_argument('--config', required=True, help='path to aws_ec2_count.yaml')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=9471)
+    args = parser.parse_args()
+
+    import yaml
+    with open(args.config) as f:
+        config = yaml.safe_load(f)
+
+    logging.basicConfig(level=logging.WARNING)
+    exporter = MetricsExporter(config.get('init_config'), config.get('instances'))
+    exporter.refresh()
+
+    refresher = threading.Thread(
+        target=exporter.run,
+        args=(float(exporter.init_config.get('min_collection_interval', 60)),),
+    )
+    refresher.daemon = True
+    refresher.start()
+
+    exporter.serve(args.host, args.port).serve_forever()
+
+
+if __name__ == '__main__':
+    main()
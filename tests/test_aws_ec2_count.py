@@ -1,3 +1,10 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
 import unittest
 from mock import Mock
 from mock import patch
@@ -174,6 +181,529 @@ class TestInstances(unittest.TestCase):
             { 'az': 'region-1b', 'itype': 't2.micro',  'family': 't2', 'size': 'micro',  'count': 5.0, 'footprint':  2.5 },
         ])
 
+    def test_rollup(self):
+        instances = aws_ec2_count.Instances()
+        self.assertEqual(instances.rollup(), ({}, { 'count': 0.0, 'footprint': 0.0 }))
+
+        instances.get('region-1a', 'm3', 'medium').set_count(5)
+        instances.get('region-1a', 'm3', 'large').set_count(5)
+        instances.get('region-1b', 'm3', 'large').set_count(1)
+        instances.get('region-1b', 'c3', 'xlarge').set_count(2)
+        instances.get('region',    'c3', 'large').set_count(3)
+
+        families, total = instances.rollup()
+        self.assertEqual(families, {
+            'm3': { 'count': 11.0, 'footprint': 34.0 },
+            'c3': { 'count':  5.0, 'footprint': 28.0 },
+        })
+        self.assertEqual(total, { 'count': 16.0, 'footprint': 62.0 })
+
+
+class TestPlatform(unittest.TestCase):
+    def test_from_instance(self):
+        self.assertEqual(aws_ec2_count.Platform.from_instance({ 'PlatformDetails': 'Linux/UNIX' }), 'Linux/UNIX')
+        self.assertEqual(aws_ec2_count.Platform.from_instance({ 'PlatformDetails': 'Red Hat Enterprise Linux' }), 'Red Hat Enterprise Linux')
+        self.assertEqual(aws_ec2_count.Platform.from_instance({ 'PlatformDetails': 'Windows with SQL Server Standard', 'Platform': 'windows' }), 'Windows with SQL Server Standard')
+
+    def test_from_instance_without_platform_details(self):
+        # botocore のモデルに PlatformDetails がない場合、RHEL・SUSE・SQL Server を Linux/UNIX や Windows として数えない
+        self.assertEqual(aws_ec2_count.Platform.from_instance({}), 'Unknown')
+        self.assertEqual(aws_ec2_count.Platform.from_instance({ 'Platform': 'windows' }), 'Unknown')
+
+    def test_from_product_description(self):
+        self.assertEqual(aws_ec2_count.Platform.from_product_description('Linux/UNIX'), 'Linux/UNIX')
+        self.assertEqual(aws_ec2_count.Platform.from_product_description('Linux/UNIX (Amazon VPC)'), 'Linux/UNIX')
+        self.assertEqual(aws_ec2_count.Platform.from_product_description('Windows (Amazon VPC)'), 'Windows')
+
+    def test_is_size_flexible(self):
+        self.assertTrue(aws_ec2_count.Platform.is_size_flexible('Linux/UNIX', 'default'))
+        self.assertFalse(aws_ec2_count.Platform.is_size_flexible('Linux/UNIX', 'dedicated'))
+        self.assertFalse(aws_ec2_count.Platform.is_size_flexible('Windows', 'default'))
+
+
+class TestInventory(unittest.TestCase):
+    def test_basic(self):
+        inventory = aws_ec2_count.Inventory()
+        self.assertFalse(inventory.has('Windows', 'default'))
+        self.assertEqual(inventory.get_all_buckets(), [])
+
+        self.assertTrue(isinstance(inventory.get('Windows', 'default'), aws_ec2_count.Instances))
+        self.assertTrue(inventory.has('Windows', 'default'))
+        inventory.get('Linux/UNIX', 'dedicated')
+        instances = aws_ec2_count.Instances()
+        self.assertTrue(inventory.set('Linux/UNIX', 'default', instances) is instances)
+        self.assertTrue(inventory.get('Linux/UNIX', 'default') is instances)
+        self.assertEqual(inventory.get_all_buckets(), [
+            ('Linux/UNIX', 'dedicated'),
+            ('Linux/UNIX', 'default'),
+            ('Windows',    'default'),
+        ])
+
+
+class TestGroupKeyIndex(unittest.TestCase):
+    def test_basic(self):
+        index = aws_ec2_count.GroupKeyIndex()
+        self.assertEqual(index.get_size(), 0)
+        self.assertEqual(index.get_id(['web', 'vpc-1']), 0)
+        self.assertEqual(index.get_id(['db',  'vpc-1']), 1)
+        self.assertEqual(index.get_id(('web', 'vpc-1')), 0)
+        self.assertEqual(index.get_size(), 2)
+        self.assertEqual(index.get_values(1), ('db', 'vpc-1'))
+
+
+class TestInstanceGroups(unittest.TestCase):
+    def test_get_group_values(self):
+        groups = aws_ec2_count.InstanceGroups(['tag:team', 'vpc', 'subnet'])
+        self.assertEqual(groups.get_tag_names(), ['ac-tag-team', 'ac-vpc', 'ac-subnet'])
+        self.assertEqual(groups.get_group_values({
+            'Tags'     : [ { 'Key': 'Name', 'Value': 'web01' }, { 'Key': 'team', 'Value': 'web' } ],
+            'VpcId'    : 'vpc-1',
+            'SubnetId' : 'subnet-1',
+        }), ['web', 'vpc-1', 'subnet-1'])
+        self.assertEqual(groups.get_group_values({}), ['none', 'none', 'none'])
+
+        groups = aws_ec2_count.InstanceGroups(['invalid'])
+        self.assertRaises(TypeError, groups.get_group_values, {})
+
+    def test_tag_key_with_colon(self):
+        # ':' を含むタグキーはタグの名前と値の区切りと区別できるよう正規化する
+        groups = aws_ec2_count.InstanceGroups(['tag:aws:autoscaling:groupName', 'tag:aws:cloudformation:stack-name'])
+        self.assertEqual(groups.get_tag_names(), ['ac-tag-aws_autoscaling_groupName', 'ac-tag-aws_cloudformation_stack-name'])
+        self.assertEqual(groups.get_group_values({
+            'Tags': [ { 'Key': 'aws:autoscaling:groupName', 'Value': 'web-asg' } ],
+        }), ['web-asg', 'none'])
+
+        self.assertRaises(TypeError, aws_ec2_count.InstanceGroups, ['tag:a:b', 'tag:a_b'])
+
+    def test_reserved_values(self):
+        # タグの値 'none' / 'other' は、タグなし・上位以外の集計と区別する
+        groups = aws_ec2_count.InstanceGroups(['tag:team'])
+        for value, expected in [ ('none', '_none'), ('Other', '_Other'), ('_none', '__none'), ('nonexistent', 'nonexistent') ]:
+            self.assertEqual(groups.get_group_values({ 'Tags': [ { 'Key': 'team', 'Value': value } ] }), [ expected ])
+        self.assertEqual(groups.get_group_values({ 'Tags': [ { 'Key': 'team', 'Value': '' } ] }), [ 'none' ])
+
+    def test_breakdown(self):
+        groups = aws_ec2_count.InstanceGroups(['tag:team'])
+        web = { 'Tags': [ { 'Key': 'team', 'Value': 'web' } ] }
+        db  = { 'Tags': [ { 'Key': 'team', 'Value': 'db' } ] }
+        self.assertEqual(groups.add('region-1a', 'c4.large', web), 0)
+        self.assertEqual(groups.add('region-1a', 'c4.large', web), 0)
+        self.assertEqual(groups.add('region-1a', 'c4.large', db), 1)
+        self.assertEqual(groups.add('region-1a', 'c4.large', db), 1)
+        self.assertEqual(groups.add('region-1b', 'm4.xlarge', db), 1)
+        self.assertEqual(groups.add('region-1b', 't2.micro', {}), 2)
+
+        running = aws_ec2_count.Instances()
+        running.get('region-1a', 'c4', 'large').set_count(4)
+        running.get('region-1b', 'm4', 'xlarge').set_count(1)
+        running.get('region-1b', 't2', 'micro').set_count(1)
+        ondemand = aws_ec2_count.Instances()
+        ondemand.get('region-1a', 'c4', 'large').set_count(2)
+        ondemand.get('region-1b', 'm4', 'xlarge').set_count(0)
+
+        breakdown = groups.breakdown(running, ondemand)
+        self.assertEqual(breakdown, {
+            0: { 'running': { 'count': 2.0, 'footprint':  8.0 }, 'ondemand': { 'count': 1.0, 'footprint': 4.0 } },
+            1: { 'running': { 'count': 3.0, 'footprint': 16.0 }, 'ondemand': { 'count': 1.0, 'footprint': 4.0 } },
+            2: { 'running': { 'count': 1.0, 'footprint':  0.5 }, 'ondemand': { 'count': 0.0, 'footprint': 0.0 } },
+        })
+
+        self.assertEqual(groups.dump(breakdown), [
+            { 'tags': ['ac-tag-team:db'],   'running': { 'count': 3.0, 'footprint': 16.0 }, 'ondemand': { 'count': 1.0, 'footprint': 4.0 } },
+            { 'tags': ['ac-tag-team:web'],  'running': { 'count': 2.0, 'footprint':  8.0 }, 'ondemand': { 'count': 1.0, 'footprint': 4.0 } },
+            { 'tags': ['ac-tag-team:none'], 'running': { 'count': 1.0, 'footprint':  0.5 }, 'ondemand': { 'count': 0.0, 'footprint': 0.0 } },
+        ])
+        self.assertEqual(groups.dump(breakdown, 1), [
+            { 'tags': ['ac-tag-team:db'],    'running': { 'count': 3.0, 'footprint': 16.0 }, 'ondemand': { 'count': 1.0, 'footprint': 4.0 } },
+            { 'tags': ['ac-tag-team:other'], 'running': { 'count': 3.0, 'footprint':  8.5 }, 'ondemand': { 'count': 1.0, 'footprint': 4.0 } },
+        ])
+
+
+class TestCoveragePipeline(unittest.TestCase):
+    def test_capacity_reservation(self):
+        stage = aws_ec2_count.CapacityReservationCoverage([
+            { 'az': 'region-1a', 'itype': 'c4.large', 'count': 3 },
+            { 'az': 'region-1b', 'itype': 'c4.large', 'count': 1, 'platform': 'Windows', 'tenancy': 'default' },
+        ])
+        self.assertEqual(stage.get_name(), 'capacity_reservation')
+
+        ondemand = aws_ec2_count.Instances()
+        ondemand.get('region-1a', 'c4', 'large').set_count(2)
+        ondemand.get('region-1b', 'c4', 'large').set_count(2)
+        aws_ec2_count.CoveragePipeline([ stage ]).apply(ondemand)
+        self.assertEqual(ondemand.dump(), [
+            { 'az': 'region-1a', 'itype': 'c4.large', 'family': 'c4', 'size': 'large', 'count': 0.0, 'footprint': 0.0 },
+            { 'az': 'region-1b', 'itype': 'c4.large', 'family': 'c4', 'size': 'large', 'count': 2.0, 'footprint': 8.0 },
+        ])
+        self.assertEqual(stage.get_covered().get('Linux/UNIX', 'default').dump(), [
+            { 'az': 'region-1a', 'itype': 'c4.large', 'family': 'c4', 'size': 'large', 'count': 2.0, 'footprint': 8.0 },
+        ])
+        self.assertEqual(stage.dump_unused(True), [
+            {
+                'tags'      : ['ac-az:region-1a', 'ac-type:c4.large', 'ac-family:c4', 'ac-platform:Linux/UNIX', 'ac-tenancy:default'],
+                'count'     : 1.0,
+                'footprint' : 4.0,
+            },
+            {
+                'tags'      : ['ac-az:region-1b', 'ac-type:c4.large', 'ac-family:c4', 'ac-platform:Windows', 'ac-tenancy:default'],
+                'count'     : 1.0,
+                'footprint' : 4.0,
+            },
+        ])
+        # all_platforms でない場合は *_covered と同じタグで、Linux/UNIX ・ default のみを返す
+        self.assertEqual(stage.dump_unused(False), [
+            { 'tags': ['ac-az:region-1a', 'ac-type:c4.large', 'ac-family:c4'], 'count': 1.0, 'footprint': 4.0 },
+        ])
+
+    def test_savings_plan(self):
+        stage = aws_ec2_count.SavingsPlanCoverage([
+            { 'family': 'c4', 'footprint': 6.0 },
+            { 'footprint': 10.0 },
+        ])
+        self.assertEqual(stage.get_name(), 'savings_plan')
+
+        ondemand = aws_ec2_count.Instances()
+        ondemand.get('region-1a', 'c4', 'large').set_count(2)   # footprint =  8
+        ondemand.get('region-1a', 'm4', 'xlarge').set_count(1)  # footprint =  8
+        aws_ec2_count.CoveragePipeline([ stage ]).apply(ondemand)
+        self.assertEqual(ondemand.dump(), [
+            { 'az': 'region-1a', 'itype': 'c4.large',  'family': 'c4', 'size': 'large',  'count': 0.0,  'footprint': 0.0 },
+            { 'az': 'region-1a', 'itype': 'm4.xlarge', 'family': 'm4', 'size': 'xlarge', 'count': 0.0,  'footprint': 0.0 },
+        ])
+        self.assertEqual(stage.get_covered().get('Linux/UNIX', 'default').dump(), [
+            { 'az': 'region-1a', 'itype': 'c4.large',  'family': 'c4', 'size': 'large',  'count': 2.0,  'footprint': 8.0 },
+            { 'az': 'region-1a', 'itype': 'm4.xlarge', 'family': 'm4', 'size': 'xlarge', 'count': 1.0,  'footprint': 8.0 },
+        ])
+        self.assertEqual(stage.dump_unused(False), [
+            { 'tags': ['ac-family:all'], 'footprint': 0.0 },
+            { 'tags': ['ac-family:c4'],  'footprint': 0.0 },
+        ])
+
+    def test_apply_in_order(self):
+        capacity_reservation = aws_ec2_count.CapacityReservationCoverage([
+            { 'az': 'region-1a', 'itype': 'c4.large', 'count': 1 },
+        ])
+        savings_plan = aws_ec2_count.SavingsPlanCoverage([
+            { 'footprint': 6.0 },
+        ])
+        pipeline = aws_ec2_count.CoveragePipeline([ capacity_reservation, savings_plan ])
+        self.assertEqual(pipeline.get_stages(), [ capacity_reservation, savings_plan ])
+
+        ondemand = aws_ec2_count.Instances()
+        ondemand.get('region-1a', 'c4', 'large').set_count(3)
+        self.assertTrue(pipeline.apply(ondemand, ('Linux/UNIX', 'default')) is ondemand)
+        self.assertEqual(ondemand.dump(), [
+            { 'az': 'region-1a', 'itype': 'c4.large', 'family': 'c4', 'size': 'large', 'count': 0.5, 'footprint': 2.0 },
+        ])
+        self.assertEqual(capacity_reservation.get_covered().get('Linux/UNIX', 'default').dump(), [
+            { 'az': 'region-1a', 'itype': 'c4.large', 'family': 'c4', 'size': 'large', 'count': 1.0, 'footprint': 4.0 },
+        ])
+        self.assertEqual(savings_plan.get_covered().get('Linux/UNIX', 'default').dump(), [
+            { 'az': 'region-1a', 'itype': 'c4.large', 'family': 'c4', 'size': 'large', 'count': 1.5, 'footprint': 6.0 },
+        ])
+
+    def test_load_commitments(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({ 'savings_plans': [ { 'footprint': 10.0 } ] }, f)
+            self.assertEqual(aws_ec2_count.CoveragePipeline.load_commitments(path), { 'savings_plans': [ { 'footprint': 10.0 } ] })
+        finally:
+            os.remove(path)
+
+    def test_load_commitments_region(self):
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({
+                    'capacity_reservations' : [
+                        { 'az': 'region-1a', 'itype': 'c4.large', 'count': 1 },
+                        { 'az': 'other-1a',  'itype': 'c4.large', 'count': 2 },
+                    ],
+                    'savings_plans' : [
+                        { 'footprint': 10.0 },
+                        { 'region': 'region', 'footprint': 20.0 },
+                        { 'region': 'other',  'footprint': 30.0 },
+                    ],
+                }, f)
+            self.assertEqual(aws_ec2_count.CoveragePipeline.load_commitments(path, 'region'), {
+                'capacity_reservations' : [ { 'az': 'region-1a', 'itype': 'c4.large', 'count': 1 } ],
+                'savings_plans'         : [ { 'footprint': 10.0 }, { 'region': 'region', 'footprint': 20.0 } ],
+            })
+        finally:
+            os.remove(path)
+
+
+class TestCheckProfiler(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_create(self):
+        self.assertTrue(aws_ec2_count.CheckProfiler.create({ 'region': 'region' }) is None)
+
+        config = { 'region': 'region', 'profiling': { 'directory': self.directory, 'every': 2 } }
+        self.assertTrue(aws_ec2_count.CheckProfiler.create(config) is None)
+        self.assertTrue(isinstance(aws_ec2_count.CheckProfiler.create(config), aws_ec2_count.CheckProfiler))
+        self.assertTrue(aws_ec2_count.CheckProfiler.create(config) is None)
+
+    def test_create_per_instance(self):
+        # 同じ Region の instance が交互に実行されても、instance ごとに every 回に 1 回プロファイルする
+        profiling = { 'directory': self.directory, 'every': 2 }
+        a = { 'region': 'region-per-instance', 'profiling': profiling, 'metrics_prefix': 'a' }
+        b = { 'region': 'region-per-instance', 'profiling': profiling, 'metrics_prefix': 'b' }
+        created = []
+        for i in range(2):
+            for config in [ a, b ]:
+                created.append(aws_ec2_count.CheckProfiler.create(config) is not None)
+        self.assertEqual(created, [ False, False, True, True ])
+
+    def test_file_name_per_instance(self):
+        # 同じ Region の instance を同時にプロファイルしても、ファイルを上書きしない
+        paths = []
+        for prefix in [ 'a', 'b' ]:
+            config = { 'region': 'region', 'profiling': { 'directory': self.directory, 'tracemalloc': False }, 'metrics_prefix': prefix }
+            profiler = aws_ec2_count.CheckProfiler.create(config)
+            profiler.start()
+            paths.extend(profiler.stop())
+        self.assertEqual(len(set(paths)), 4)
+        self.assertEqual(len(os.listdir(self.directory)), 4)
+
+    def test_profile(self):
+        directory = os.path.join(self.directory, 'profiles')
+        profiler = aws_ec2_count.CheckProfiler('region', { 'directory': directory, 'top_allocations': 5 })
+        profiler.start()
+        instances = aws_ec2_count.Instances()
+        instances.get('region-1a', 'c4', 'large').set_count(3)
+        profiler.mark('running')
+        profiler.set_fleet_size(3)
+        instances.dump()
+        profiler.mark('send')
+        paths = profiler.stop()
+
+        self.assertEqual([ stage for stage, seconds in profiler.get_stages() ], [ 'running', 'send' ])
+        self.assertEqual(len(paths), 2)
+        self.assertTrue(paths[0].endswith('-n3.prof'))
+        self.assertTrue(paths[1].endswith('-n3.txt'))
+        self.assertTrue(os.path.basename(paths[0]).startswith('aws_ec2_count-region-'))
+        for path in paths:
+            self.assertTrue(os.path.isfile(path))
+        with open(paths[1]) as f:
+            report = f.read()
+        self.assertTrue('region     : region\n' in report)
+        self.assertTrue('fleet size : 3\n' in report)
+        self.assertTrue('stage      : running = ' in report)
+        self.assertTrue('stage      : send = ' in report)
+
+    @unittest.skipIf(aws_ec2_count.tracemalloc is None, 'tracemalloc is not available')
+    def test_tracemalloc_started_elsewhere(self):
+        # 既に開始されている tracemalloc は停止しない
+        tracemalloc = aws_ec2_count.tracemalloc
+        tracemalloc.start()
+        try:
+            profiler = aws_ec2_count.CheckProfiler('region', { 'directory': self.directory })
+            profiler.start()
+            profiler.stop()
+            self.assertTrue(tracemalloc.is_tracing())
+        finally:
+            tracemalloc.stop()
+
+        profiler = aws_ec2_count.CheckProfiler('region', { 'directory': self.directory })
+        profiler.start()
+        self.assertTrue(tracemalloc.is_tracing())
+        profiler.stop()
+        self.assertFalse(tracemalloc.is_tracing())
+
+
+class TestCircuitBreaker(unittest.TestCase):
+    def test_basic(self):
+        now = [ 1000.0 ]
+        breaker = aws_ec2_count.CircuitBreaker(failure_threshold=2, cooldown=60, clock=lambda: now[0])
+        self.assertEqual(breaker.get_state(), 'closed')
+        self.assertTrue(breaker.allow())
+
+        breaker.record_failure()
+        self.assertEqual(breaker.get_state(), 'closed')
+        breaker.record_success()
+        breaker.record_failure()
+        self.assertEqual(breaker.get_state(), 'closed')
+        breaker.record_failure()
+        self.assertEqual(breaker.get_state(), 'open')
+        self.assertFalse(breaker.allow())
+
+        # cooldown 経過後は 1 回だけ試行する
+        now[0] += 60
+        self.assertTrue(breaker.allow())
+        self.assertEqual(breaker.get_state(), 'half-open')
+        self.assertFalse(breaker.allow())
+        breaker.record_failure()
+        self.assertEqual(breaker.get_state(), 'open')
+        self.assertFalse(breaker.allow())
+
+        now[0] += 60
+        self.assertTrue(breaker.allow())
+        breaker.record_success()
+        self.assertEqual(breaker.get_state(), 'closed')
+        self.assertTrue(breaker.allow())
+
+    def test_get(self):
+        breaker = aws_ec2_count.CircuitBreaker.get('region-breaker', 'describe_instances')
+        self.assertTrue(aws_ec2_count.CircuitBreaker.get('region-breaker', 'describe_instances') is breaker)
+        self.assertFalse(aws_ec2_count.CircuitBreaker.get('region-breaker', 'describe_reserved_instances') is breaker)
+        self.assertFalse(aws_ec2_count.CircuitBreaker.get('region-breaker', 'describe_instances', failure_threshold=5) is breaker)
+        self.assertFalse(aws_ec2_count.CircuitBreaker.get('region-breaker', 'describe_instances', cooldown=60) is breaker)
+
+    def test_concurrent_half_open(self):
+        # cooldown 経過後、並行して呼び出しても試行できるのは 1 つだけ
+        now = [ 1000.0 ]
+        breaker = aws_ec2_count.CircuitBreaker(failure_threshold=1, cooldown=60, clock=lambda: now[0])
+        breaker.record_failure()
+        now[0] += 60
+
+        barrier = threading.Event()
+        allowed = []
+
+        def probe():
+            barrier.wait()
+            allowed.append(breaker.allow())
+
+        threads = [ threading.Thread(target=probe) for i in range(16) ]
+        for thread in threads:
+            thread.start()
+        barrier.set()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(allowed.count(True), 1)
+        self.assertEqual(breaker.get_state(), 'half-open')
+
+
+class TestRequestCache(unittest.TestCase):
+    def setUp(self):
+        aws_ec2_count.RequestCache.clear()
+
+    def test_ttl(self):
+        fetch = Mock(side_effect=[ 'first', 'second' ])
+        with patch('aws_ec2_count.time') as mock_time:
+            mock_time.time.return_value = 1000.0
+            self.assertEqual(aws_ec2_count.RequestCache.get('key', 10, fetch), 'first')
+            mock_time.time.return_value = 1009.0
+            self.assertEqual(aws_ec2_count.RequestCache.get('key', 10, fetch), 'first')
+            self.assertEqual(fetch.call_count, 1)
+            mock_time.time.return_value = 1010.0
+            self.assertEqual(aws_ec2_count.RequestCache.get('key', 10, fetch), 'second')
+            self.assertEqual(fetch.call_count, 2)
+
+    def test_error(self):
+        fetch = Mock(side_effect=[ Exception('Throttling'), 'result' ])
+        self.assertRaises(Exception, aws_ec2_count.RequestCache.get, 'key', 10, fetch)
+        self.assertEqual(aws_ec2_count.RequestCache.get('key', 10, fetch), 'result')
+
+    def test_base_exception(self):
+        # BaseException で中断した呼び出しの結果 ( None ) をキャッシュしない
+        fetch = Mock(side_effect=[ KeyboardInterrupt(), 'result' ])
+        self.assertRaises(KeyboardInterrupt, aws_ec2_count.RequestCache.get, 'key', 10, fetch)
+        self.assertEqual(aws_ec2_count.RequestCache.get('key', 10, fetch), 'result')
+        self.assertEqual(fetch.call_count, 2)
+
+    def test_concurrent(self):
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def fetch():
+            calls.append(1)
+            started.set()
+            release.wait()
+            return 'result'
+
+        results = []
+
+        def get():
+            results.append(aws_ec2_count.RequestCache.get('key', 10, fetch))
+
+        owner = threading.Thread(target=get)
+        owner.start()
+        started.wait()
+        waiters = [ threading.Thread(target=get) for i in range(3) ]
+        for waiter in waiters:
+            waiter.start()
+        release.set()
+        for thread in [ owner ] + waiters:
+            thread.join()
+
+        self.assertEqual(len(calls), 1)
+        self.assertEqual(results, [ 'result' ] * 4)
+
+
+class TestDogStatsdSink(unittest.TestCase):
+    def setUp(self):
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.settimeout(5)
+        self.port = self.listener.getsockname()[1]
+
+    def tearDown(self):
+        self.listener.close()
+
+    def test_udp(self):
+        sink = aws_ec2_count.DogStatsdSink('127.0.0.1', self.port, max_packet_size=80)
+        sink.gauge('aws_ec2_count.running.count',     2,   ['ac-az:region-1a', 'ac-type:c4.large'])
+        sink.gauge('aws_ec2_count.running.footprint', 8.0, ['ac-az:region-1a', 'ac-type:c4.large'])
+        sink.gauge('aws_ec2_count.total.count',       0.5)
+        sink.flush()
+        sink.flush()
+
+        self.assertEqual(self.listener.recv(65535), b'aws_ec2_count.running.count:2.0|g|#ac-az:region-1a,ac-type:c4.large')
+        self.assertEqual(self.listener.recv(65535), b'aws_ec2_count.running.footprint:8.0|g|#ac-az:region-1a,ac-type:c4.large')
+        self.assertEqual(self.listener.recv(65535), b'aws_ec2_count.total.count:0.5|g')
+        self.assertEqual(sink.get_dropped(), 0)
+        sink.close()
+
+    def test_coalescing(self):
+        sink = aws_ec2_count.DogStatsdSink('127.0.0.1', self.port)
+        lines = []
+        for i in range(100):
+            sink.gauge('aws_ec2_count.running.count', i, ['ac-az:region-1a', 'ac-type:c4.large'])
+            lines.append('aws_ec2_count.running.count:{}|g|#ac-az:region-1a,ac-type:c4.large'.format(float(i)).encode('utf-8'))
+        sink.flush()
+
+        received = []
+        while len(received) < len(lines):
+            packet = self.listener.recv(65535)
+            self.assertTrue(len(packet) <= aws_ec2_count.DogStatsdSink.UDP_MAX_PACKET_SIZE)
+            received.extend(packet.split(b'\n'))
+        self.assertEqual(received, lines)
+        sink.close()
+
+    def test_unix_socket(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'dsd.socket')
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        try:
+            listener.bind(path)
+            listener.settimeout(5)
+            sink = aws_ec2_count.DogStatsdSink(socket_path=path)
+            sink.gauge('aws_ec2_count.running.count', 1, ['ac-az:region-1a'])
+            sink.gauge('aws_ec2_count.running.count', 2, ['ac-az:region-1b'])
+            sink.flush()
+            self.assertEqual(listener.recv(65535), b'aws_ec2_count.running.count:1.0|g|#ac-az:region-1a\naws_ec2_count.running.count:2.0|g|#ac-az:region-1b')
+        finally:
+            listener.close()
+            shutil.rmtree(directory)
+
+        # 送信先がない場合は破棄する
+        sink.gauge('aws_ec2_count.running.count', 1)
+        sink.close()
+        self.assertEqual(sink.get_dropped(), 1)
+
+    def test_get(self):
+        sink = aws_ec2_count.DogStatsdSink.get(port=self.port)
+        self.assertTrue(aws_ec2_count.DogStatsdSink.get(port=self.port) is sink)
+        self.assertFalse(aws_ec2_count.DogStatsdSink.get(port=self.port, max_packet_size=512) is sink)
+
 
 class TestInstanceFetcher(unittest.TestCase):
     def setUp(self):
@@ -239,6 +769,206 @@ class TestInstanceFetcher(unittest.TestCase):
             { 'az': 'region-1b', 'itype': 'c3.xlarge', 'family': 'c3', 'size': 'xlarge', 'count': 1.0, 'footprint': 8.0 },
         ])
 
+    def test_request_cache(self):
+        aws_ec2_count.RequestCache.clear()
+        self.mock_session_object.get_credentials.return_value.access_key = 'AKIA'
+        self.mock_ec2_client.describe_instances.return_value = {
+            'Reservations': [
+                {
+                    'Instances': [
+                        {
+                            'Placement'    : { 'AvailabilityZone' : 'region-1a' },
+                            'InstanceType' : 'c3.large',
+                        },
+                    ]
+                },
+            ]
+        }
+
+        fetchers = [ aws_ec2_count.InstanceFetcher('region-cache', cache_ttl=60) for i in range(3) ]
+        for fetcher in fetchers:
+            self.assertEqual(fetcher.get_running_instances().dump(), [
+                { 'az': 'region-1a', 'itype': 'c3.large', 'family': 'c3', 'size': 'large', 'count': 1.0, 'footprint': 4.0 },
+            ])
+        self.assertEqual(self.mock_ec2_client.describe_instances.call_count, 1)
+
+        # 絞り込み条件が異なれば共有しない
+        fetchers[0].get_running_inventory()
+        self.assertEqual(self.mock_ec2_client.describe_instances.call_count, 2)
+
+        # 認証情報が異なれば共有しない
+        self.mock_session_object.get_credentials.return_value.access_key = 'AKIB'
+        aws_ec2_count.InstanceFetcher('region-cache', cache_ttl=60).get_running_instances()
+        self.assertEqual(self.mock_ec2_client.describe_instances.call_count, 3)
+
+        # cache_ttl を指定しなければ共有しない
+        aws_ec2_count.InstanceFetcher('region-cache').get_running_instances()
+        self.assertEqual(self.mock_ec2_client.describe_instances.call_count, 4)
+
+    def test_circuit_breaker(self):
+        self.mock_ec2_client.describe_instances.side_effect = Exception('Throttling')
+
+        fetcher = aws_ec2_count.InstanceFetcher('region-circuit', { 'failure_threshold': 2, 'cooldown': 300 })
+        self.assertRaises(Exception, fetcher.get_running_instances)
+        self.assertRaises(Exception, fetcher.get_running_instances)
+        self.assertEqual(self.mock_ec2_client.describe_instances.call_count, 2)
+
+        self.assertRaises(aws_ec2_count.CircuitOpenError, fetcher.get_running_instances)
+        self.assertEqual(self.mock_ec2_client.describe_instances.call_count, 2)
+        self.assertEqual(aws_ec2_count.CircuitBreaker.get('region-circuit', 'describe_instances', 2, 300).get_state(), 'open')
+        self.assertEqual(aws_ec2_count.CircuitBreaker.get('region-circuit', 'describe_reserved_instances', 2, 300).get_state(), 'closed')
+
+    def test_circuit_breaker_interrupted(self):
+        self.mock_ec2_client.describe_instances.side_effect = [ Exception('Throttling'), KeyboardInterrupt(), { 'Reservations': [] } ]
+
+        fetcher = aws_ec2_count.InstanceFetcher('region-circuit-interrupted', { 'failure_threshold': 1, 'cooldown': 0 })
+        self.assertRaises(Exception, fetcher.get_running_instances)
+
+        # half-open の試行が中断されても open に戻り、次の試行で再開できる
+        self.assertRaises(KeyboardInterrupt, fetcher.get_running_instances)
+        self.assertEqual(aws_ec2_count.CircuitBreaker.get('region-circuit-interrupted', 'describe_instances', 1, 0).get_state(), 'open')
+        fetcher.get_running_instances()
+        self.assertEqual(aws_ec2_count.CircuitBreaker.get('region-circuit-interrupted', 'describe_instances', 1, 0).get_state(), 'closed')
+        self.assertEqual(self.mock_ec2_client.describe_instances.call_count, 3)
+
+    def test_get_running_inventory(self):
+        self.mock_ec2_client.describe_instances.side_effect = [
+            {
+                'Reservations': [
+                    {
+                        'Instances': [
+                            {
+                                # SpotInstance
+                                'Placement'    : { 'AvailabilityZone' : 'region-1a', 'Tenancy' : 'default' },
+                                'InstanceType' : 'c3.large',
+                                'SpotInstanceRequestId': 'hoge',
+                            },
+                            {
+                                'Placement'       : { 'AvailabilityZone' : 'region-1a', 'Tenancy' : 'default' },
+                                'InstanceType'    : 'c3.large',
+                                'PlatformDetails' : 'Linux/UNIX',
+                            },
+                            {
+                                'Placement'       : { 'AvailabilityZone' : 'region-1a', 'Tenancy' : 'default' },
+                                'InstanceType'    : 'c3.large',
+                                'Platform'        : 'windows',
+                                'PlatformDetails' : 'Windows',
+                            },
+                        ]
+                    },
+                ],
+                'NextToken': 'next',
+            },
+            {
+                'Reservations': [
+                    {
+                        'Instances': [
+                            {
+                                'Placement'       : { 'AvailabilityZone' : 'region-1b', 'Tenancy' : 'dedicated' },
+                                'InstanceType'    : 'm4.xlarge',
+                                'PlatformDetails' : 'Red Hat Enterprise Linux',
+                                'Tags'            : [ { 'Key': 'team', 'Value': 'db' } ],
+                            },
+                        ]
+                    },
+                ],
+            },
+        ]
+
+        fetcher = aws_ec2_count.InstanceFetcher('region')
+        groups = aws_ec2_count.InstanceGroups(['tag:team'])
+        inventory = fetcher.get_running_inventory(groups)
+        self.assertEqual(self.mock_ec2_client.describe_instances.call_count, 2)
+        self.assertEqual(inventory.get_all_buckets(), [
+            ('Linux/UNIX',               'default'),
+            ('Red Hat Enterprise Linux', 'dedicated'),
+            ('Windows',                  'default'),
+        ])
+        self.assertEqual(inventory.get('Linux/UNIX', 'default').dump(), [
+            { 'az': 'region-1a', 'itype': 'c3.large',  'family': 'c3', 'size': 'large',  'count': 1.0, 'footprint': 4.0 },
+        ])
+        self.assertEqual(inventory.get('Red Hat Enterprise Linux', 'dedicated').dump(), [
+            { 'az': 'region-1b', 'itype': 'm4.xlarge', 'family': 'm4', 'size': 'xlarge', 'count': 1.0, 'footprint': 8.0 },
+        ])
+        self.assertEqual(inventory.get('Windows', 'default').dump(), [
+            { 'az': 'region-1a', 'itype': 'c3.large',  'family': 'c3', 'size': 'large',  'count': 1.0, 'footprint': 4.0 },
+        ])
+
+        breakdown = groups.breakdown(
+            inventory.get('Red Hat Enterprise Linux', 'dedicated'),
+            aws_ec2_count.Instances(),
+            bucket=('Red Hat Enterprise Linux', 'dedicated'),
+        )
+        self.assertEqual(groups.dump(breakdown), [
+            { 'tags': ['ac-tag-team:db'], 'running': { 'count': 1.0, 'footprint': 8.0 }, 'ondemand': { 'count': 0.0, 'footprint': 0.0 } },
+        ])
+
+    def test_get_running_inventory_without_platform_details(self):
+        # 古い botocore では PlatformDetails がレスポンスから取り除かれる
+        self.mock_ec2_client.describe_instances.return_value = {
+            'Reservations': [
+                {
+                    'Instances': [
+                        {
+                            # RHEL
+                            'Placement'    : { 'AvailabilityZone' : 'region-1a', 'Tenancy' : 'default' },
+                            'InstanceType' : 'c3.large',
+                        },
+                        {
+                            # Windows with SQL Server
+                            'Placement'    : { 'AvailabilityZone' : 'region-1a', 'Tenancy' : 'default' },
+                            'InstanceType' : 'c3.large',
+                            'Platform'     : 'windows',
+                        },
+                    ]
+                },
+            ],
+        }
+
+        fetcher = aws_ec2_count.InstanceFetcher('region')
+        inventory = fetcher.get_running_inventory()
+        self.assertEqual(inventory.get_all_buckets(), [ ('Unknown', 'default') ])
+        self.assertEqual(inventory.get('Unknown', 'default').dump(), [
+            { 'az': 'region-1a', 'itype': 'c3.large', 'family': 'c3', 'size': 'large', 'count': 2.0, 'footprint': 8.0 },
+        ])
+
+    def test_get_running_instances_with_groups(self):
+        self.mock_ec2_client.describe_instances.return_value = {
+            'Reservations': [
+                {
+                    'Instances': [
+                        {
+                            'Placement'    : { 'AvailabilityZone' : 'region-1a' },
+                            'InstanceType' : 'c3.large',
+                            'VpcId'        : 'vpc-1',
+                            'Tags'         : [ { 'Key': 'team', 'Value': 'web' } ],
+                        },
+                        {
+                            'Placement'    : { 'AvailabilityZone' : 'region-1a' },
+                            'InstanceType' : 'c3.large',
+                            'VpcId'        : 'vpc-1',
+                            'Tags'         : [ { 'Key': 'team', 'Value': 'web' } ],
+                        },
+                        {
+                            'Placement'    : { 'AvailabilityZone' : 'region-1b' },
+                            'InstanceType' : 'c3.xlarge',
+                            'VpcId'        : 'vpc-2',
+                        },
+                    ]
+                },
+            ]
+        }
+
+        fetcher = aws_ec2_count.InstanceFetcher('region')
+        groups = aws_ec2_count.InstanceGroups(['tag:team', 'vpc'])
+        instances = fetcher.get_running_instances(groups)
+        self.assertEqual(len(instances.dump()), 2)
+        self.assertEqual(groups.get_index().get_size(), 2)
+        self.assertEqual(groups.dump(groups.breakdown(instances, aws_ec2_count.Instances())), [
+            { 'tags': ['ac-tag-team:web',  'ac-vpc:vpc-1'], 'running': { 'count': 2.0, 'footprint': 8.0 }, 'ondemand': { 'count': 0.0, 'footprint': 0.0 } },
+            { 'tags': ['ac-tag-team:none', 'ac-vpc:vpc-2'], 'running': { 'count': 1.0, 'footprint': 8.0 }, 'ondemand': { 'count': 0.0, 'footprint': 0.0 } },
+        ])
+
     def test_get_reserved_instances(self):
         fetcher = aws_ec2_count.InstanceFetcher('region')
 
@@ -323,6 +1053,58 @@ class TestInstanceFetcher(unittest.TestCase):
         instances = fetcher.get_reserved_instances()
         self.assertTrue(instances is None)
 
+    def test_get_reserved_inventory(self):
+        fetcher = aws_ec2_count.InstanceFetcher('region')
+
+        self.mock_ec2_client.describe_reserved_instances.return_value = {
+            'ReservedInstances' : [
+                {
+                    'ReservedInstancesId': 1,
+                    'Scope'              : 'Availability Zone',
+                    'AvailabilityZone'   : 'region-1a',
+                    'InstanceType'       : 'c3.large',
+                    'InstanceCount'      : 2,
+                    'ProductDescription' : 'Linux/UNIX',
+                    'InstanceTenancy'    : 'default',
+                },
+                {
+                    'ReservedInstancesId': 2,
+                    'Scope'              : 'Region',
+                    'InstanceType'       : 'c3.large',
+                    'InstanceCount'      : 1,
+                    'ProductDescription' : 'Linux/UNIX (Amazon VPC)',
+                    'InstanceTenancy'    : 'default',
+                },
+                {
+                    'ReservedInstancesId': 3,
+                    'Scope'              : 'Region',
+                    'InstanceType'       : 'm4.xlarge',
+                    'InstanceCount'      : 3,
+                    'ProductDescription' : 'Windows (Amazon VPC)',
+                    'InstanceTenancy'    : 'dedicated',
+                },
+            ],
+        }
+        self.mock_ec2_client.describe_reserved_instances_modifications.return_value = { 'ReservedInstancesModifications': [] }
+        inventory = fetcher.get_reserved_inventory()
+        self.assertEqual(inventory.get_all_buckets(), [
+            ('Linux/UNIX', 'default'),
+            ('Windows',    'dedicated'),
+        ])
+        self.assertEqual(inventory.get('Linux/UNIX', 'default').dump(), [
+            { 'az': 'region',    'itype': 'c3.large',  'family': 'c3', 'size': 'large',  'count': 1.0, 'footprint':  4.0 },
+            { 'az': 'region-1a', 'itype': 'c3.large',  'family': 'c3', 'size': 'large',  'count': 2.0, 'footprint':  8.0 },
+        ])
+        self.assertEqual(inventory.get('Windows', 'dedicated').dump(), [
+            { 'az': 'region',    'itype': 'm4.xlarge', 'family': 'm4', 'size': 'xlarge', 'count': 3.0, 'footprint': 24.0 },
+        ])
+
+        # processing status
+        self.mock_ec2_client.describe_reserved_instances_modifications.return_value = {
+            'ReservedInstancesModifications': [ { 'ModificationResults': [ {} ] } ],
+        }
+        self.assertTrue(fetcher.get_reserved_inventory() is None)
+
     def test_get_ondemand_instances(self):
         fetcher = aws_ec2_count.InstanceFetcher('region')
 
@@ -413,6 +1195,97 @@ class TestInstanceFetcher(unittest.TestCase):
             { 'az': 'region-1b', 'itype': 'c4.xlarge', 'family': 'c4', 'size': 'xlarge', 'count': 0.0, 'footprint':  0.0 },
         ])
 
+    def test_get_capacity_reservations(self):
+        self.mock_ec2_client.describe_capacity_reservations.side_effect = [
+            {
+                'CapacityReservations': [
+                    {
+                        'InstancePlatform'   : 'Linux/UNIX',
+                        'Tenancy'            : 'default',
+                        'AvailabilityZone'   : 'region-1a',
+                        'InstanceType'       : 'c4.large',
+                        'TotalInstanceCount' : 2,
+                    },
+                ],
+                'NextToken': 'next',
+            },
+            {
+                'CapacityReservations': [
+                    {
+                        'InstancePlatform'   : 'Windows',
+                        'Tenancy'            : 'dedicated',
+                        'AvailabilityZone'   : 'region-1b',
+                        'InstanceType'       : 'm4.xlarge',
+                        'TotalInstanceCount' : 1,
+                    },
+                ],
+            },
+        ]
+
+        fetcher = aws_ec2_count.InstanceFetcher('region')
+        self.assertEqual(fetcher.get_capacity_reservations(), [
+            { 'platform': 'Linux/UNIX', 'tenancy': 'default',   'az': 'region-1a', 'itype': 'c4.large',  'count': 2 },
+            { 'platform': 'Windows',    'tenancy': 'dedicated', 'az': 'region-1b', 'itype': 'm4.xlarge', 'count': 1 },
+        ])
+        self.assertEqual(self.mock_ec2_client.describe_capacity_reservations.call_count, 2)
+
+    def test_get_ondemand_instances_not_size_flexible(self):
+        fetcher = aws_ec2_count.InstanceFetcher('region')
+
+        running_instances  = aws_ec2_count.Instances()
+        running_instances.get('region-1a', 'm4', 'large').set_count(2)
+        running_instances.get('region-1a', 'm4', 'xlarge').set_count(1)
+        reserved_instances = aws_ec2_count.Instances()
+        reserved_instances.get('region', 'm4', 'xlarge').set_count(2)
+        ondemand_instances, unused_instances = fetcher.get_ondemand_instances(
+            running_instances, reserved_instances, size_flexible=False,
+        )
+        self.assertEqual(ondemand_instances.dump(), [
+            { 'az': 'region-1a', 'itype': 'm4.large',  'family': 'm4', 'size': 'large',  'count': 2.0, 'footprint': 8.0 },
+            { 'az': 'region-1a', 'itype': 'm4.xlarge', 'family': 'm4', 'size': 'xlarge', 'count': 0.0, 'footprint': 0.0 },
+        ])
+        self.assertEqual(unused_instances.dump(), [
+            { 'az': 'region', 'itype': 'm4.xlarge', 'family': 'm4', 'size': 'xlarge', 'count': 1.0, 'footprint': 8.0 },
+        ])
+
+    def test_get_ondemand_inventory(self):
+        fetcher = aws_ec2_count.InstanceFetcher('region')
+
+        running_inventory = aws_ec2_count.Inventory()
+        running_inventory.get('Linux/UNIX', 'default').get('region-1a', 'm4', 'large').set_count(2)
+        running_inventory.get('Windows',    'default').get('region-1a', 'm4', 'large').set_count(2)
+        reserved_inventory = aws_ec2_count.Inventory()
+        reserved_inventory.get('Linux/UNIX', 'default').get('region', 'm4', 'xlarge').set_count(1)
+        reserved_inventory.get('Windows',    'default').get('region', 'm4', 'xlarge').set_count(1)
+        reserved_inventory.get('SUSE Linux', 'default').get('region', 'c4', 'large').set_count(1)
+
+        ondemand_inventory, unused_inventory = fetcher.get_ondemand_inventory(running_inventory, reserved_inventory)
+        self.assertEqual(ondemand_inventory.get_all_buckets(), [
+            ('Linux/UNIX', 'default'),
+            ('SUSE Linux', 'default'),
+            ('Windows',    'default'),
+        ])
+        self.assertEqual(running_inventory.get_all_buckets(), [
+            ('Linux/UNIX', 'default'),
+            ('Windows',    'default'),
+        ])
+        self.assertEqual(ondemand_inventory.get('Linux/UNIX', 'default').dump(), [
+            { 'az': 'region-1a', 'itype': 'm4.large', 'family': 'm4', 'size': 'large', 'count': 0.0, 'footprint': 0.0 },
+        ])
+        self.assertEqual(ondemand_inventory.get('Windows', 'default').dump(), [
+            { 'az': 'region-1a', 'itype': 'm4.large', 'family': 'm4', 'size': 'large', 'count': 2.0, 'footprint': 8.0 },
+        ])
+        self.assertEqual(ondemand_inventory.get('SUSE Linux', 'default').dump(), [])
+        self.assertEqual(unused_inventory.get('Linux/UNIX', 'default').dump(), [
+            { 'az': 'region', 'itype': 'm4.xlarge', 'family': 'm4', 'size': 'xlarge', 'count': 0.0, 'footprint': 0.0 },
+        ])
+        self.assertEqual(unused_inventory.get('Windows', 'default').dump(), [
+            { 'az': 'region', 'itype': 'm4.xlarge', 'family': 'm4', 'size': 'xlarge', 'count': 1.0, 'footprint': 8.0 },
+        ])
+        self.assertEqual(unused_inventory.get('SUSE Linux', 'default').dump(), [
+            { 'az': 'region', 'itype': 'c4.large',  'family': 'c4', 'size': 'large',  'count': 1.0, 'footprint': 4.0 },
+        ])
+
 
 class TestAwsEc2Count(unittest.TestCase):
     def setUp(self):
@@ -529,3 +1402,537 @@ class TestAwsEc2Count(unittest.TestCase):
         self.assert_gauge(14, call('aws_ec2_count.reserved_unused.footprint', 28.0, tags=['ac-az:region-1a', 'ac-type:m3.large',  'ac-family:m3']))
         self.assert_gauge(15, call('aws_ec2_count.reserved_unused.count',      8.0, tags=['ac-az:region-1a', 'ac-type:m3.xlarge', 'ac-family:m3']))
         self.assert_gauge(16, call('aws_ec2_count.reserved_unused.footprint', 64.0, tags=['ac-az:region-1a', 'ac-type:m3.xlarge', 'ac-family:m3']))
+
+    def test_check_aggregation_levels(self):
+        self.reset_mock()
+        running = aws_ec2_count.Instances()
+        running.get('region-1a', 'c4', 'large').set_count(1)
+        running.get('region-1b', 'c4', 'xlarge').set_count(2)
+        running.get('region-1b', 'm4', 'large').set_count(3)
+        self.mock_running.return_value  = running
+        self.mock_reserved.return_value = aws_ec2_count.Instances()
+        self.mock_ondemand.return_value = ( aws_ec2_count.Instances(), aws_ec2_count.Instances() )
+
+        counter = aws_ec2_count.AwsEc2Count()
+        counter.check({ 'region': 'region', 'aggregation_levels': [ 'family', 'region' ] })
+
+        self.assert_log_count('info', 7)
+        self.assert_gauge_count(12)
+        self.assert_gauge( 1, call('aws_ec2_count.reserved.region.count',      0.0, tags=['ac-region:region']))
+        self.assert_gauge( 2, call('aws_ec2_count.reserved.region.footprint',  0.0, tags=['ac-region:region']))
+        self.assert_gauge( 3, call('aws_ec2_count.running.family.count',       3.0, tags=['ac-region:region', 'ac-family:c4']))
+        self.assert_gauge( 4, call('aws_ec2_count.running.family.footprint',  20.0, tags=['ac-region:region', 'ac-family:c4']))
+        self.assert_gauge( 5, call('aws_ec2_count.running.family.count',       3.0, tags=['ac-region:region', 'ac-family:m4']))
+        self.assert_gauge( 6, call('aws_ec2_count.running.family.footprint',  12.0, tags=['ac-region:region', 'ac-family:m4']))
+        self.assert_gauge( 7, call('aws_ec2_count.running.region.count',       6.0, tags=['ac-region:region']))
+        self.assert_gauge( 8, call('aws_ec2_count.running.region.footprint',  32.0, tags=['ac-region:region']))
+
+    def test_check_unknown_aggregation_level(self):
+        # 複数の instance で同じ metric context を上書きし合うため、タグなしの total は提供しない
+        self.reset_mock()
+        self.mock_reserved.return_value = aws_ec2_count.Instances()
+
+        counter = aws_ec2_count.AwsEc2Count()
+        with self.assertRaises(TypeError):
+            counter.check({ 'region': 'region-unknown-level', 'aggregation_levels': [ 'total' ] })
+        self.assert_gauge_count(0)
+
+    def test_check_max_az_series(self):
+        self.reset_mock()
+        running = aws_ec2_count.Instances()
+        running.get('region-1a', 'c4', 'large').set_count(1)   # footprint =  4
+        running.get('region-1a', 'c4', 'xlarge').set_count(2)  # footprint = 16
+        running.get('region-1b', 'm4', 'large').set_count(3)   # footprint = 12
+        self.mock_running.return_value  = running
+        self.mock_reserved.return_value = aws_ec2_count.Instances()
+        self.mock_ondemand.return_value = ( aws_ec2_count.Instances(), aws_ec2_count.Instances() )
+
+        counter = aws_ec2_count.AwsEc2Count()
+        counter.check({ 'region': 'region', 'max_az_series': 2 })
+
+        self.assert_log_count('info', 7)
+        self.assert_gauge_count(4)
+        self.assert_gauge(1, call('aws_ec2_count.running.count',      2.0, tags=['ac-az:region-1a', 'ac-type:c4.xlarge', 'ac-family:c4']))
+        self.assert_gauge(2, call('aws_ec2_count.running.footprint', 16.0, tags=['ac-az:region-1a', 'ac-type:c4.xlarge', 'ac-family:c4']))
+        self.assert_gauge(3, call('aws_ec2_count.running.count',      3.0, tags=['ac-az:region-1b', 'ac-type:m4.large',  'ac-family:m4']))
+        self.assert_gauge(4, call('aws_ec2_count.running.footprint', 12.0, tags=['ac-az:region-1b', 'ac-type:m4.large',  'ac-family:m4']))
+
+        self.reset_mock()
+        counter.check({ 'region': 'region', 'max_az_series': 0 })
+        self.assert_gauge_count(0)
+
+    def test_check_max_az_series_all_platforms(self):
+        # max_az_series は platform・tenancy の bucket ごとではなく category 全体に適用する
+        self.reset_mock()
+        running_inventory = aws_ec2_count.Inventory()
+        running_inventory.get('Linux/UNIX', 'default').get('region-1a', 'c4', 'large').set_count(1)   # footprint =  4
+        running_inventory.get('Linux/UNIX', 'default').get('region-1a', 'c4', 'xlarge').set_count(2)  # footprint = 16
+        running_inventory.get('Windows', 'default').get('region-1a', 'm4', 'large').set_count(3)      # footprint = 12
+        running_inventory.get('Windows', 'default').get('region-1b', 'm4', 'large').set_count(1)      # footprint =  4
+
+        with patch('aws_ec2_count.InstanceFetcher.get_running_inventory') as mock_running_inventory, \
+                patch('aws_ec2_count.InstanceFetcher.get_reserved_inventory') as mock_reserved_inventory:
+            mock_running_inventory.return_value  = running_inventory
+            mock_reserved_inventory.return_value = aws_ec2_count.Inventory()
+            self.patcher_ondemand.stop()
+            try:
+                counter = aws_ec2_count.AwsEc2Count()
+                counter.check({ 'region': 'region', 'all_platforms': True, 'max_az_series': 2 })
+            finally:
+                self.patcher_ondemand.start()
+
+        running = [ c for c in self.mock_gauge.call_args_list if c[0][0] == 'aws_ec2_count.running.count' ]
+        self.assertEqual(running, [
+            call('aws_ec2_count.running.count', 2.0, tags=['ac-az:region-1a', 'ac-type:c4.xlarge', 'ac-family:c4', 'ac-platform:Linux/UNIX', 'ac-tenancy:default']),
+            call('aws_ec2_count.running.count', 3.0, tags=['ac-az:region-1a', 'ac-type:m4.large',  'ac-family:m4', 'ac-platform:Windows',    'ac-tenancy:default']),
+        ])
+
+    def test_check_group_by(self):
+        self.reset_mock()
+
+        def get_running_instances(groups):
+            running = aws_ec2_count.Instances()
+            running.get('region-1a', 'c4', 'large').set_count(2)
+            groups.add('region-1a', 'c4.large', { 'Tags': [ { 'Key': 'team', 'Value': 'web' } ] })
+            groups.add('region-1a', 'c4.large', { 'Tags': [ { 'Key': 'team', 'Value': 'db' } ] })
+            return running
+        self.mock_running.side_effect   = get_running_instances
+        self.mock_reserved.return_value = aws_ec2_count.Instances()
+        ondemand = aws_ec2_count.Instances()
+        ondemand.get('region-1a', 'c4', 'large').set_count(1)
+        self.mock_ondemand.return_value = ( ondemand, aws_ec2_count.Instances() )
+
+        counter = aws_ec2_count.AwsEc2Count()
+        counter.check({ 'region': 'region', 'aggregation_levels': [], 'group_by': [ 'tag:team' ], 'group_limit': 1 })
+
+        self.assert_log_count('info', 9)
+        self.assert_log('info', 7, 'group')
+        self.assert_log('info', 8, 'ac-tag-team:web : running = 1.0 (4.0), ondemand = 0.5 (2.0)')
+        self.assert_log('info', 9, 'ac-tag-team:other : running = 1.0 (4.0), ondemand = 0.5 (2.0)')
+        self.assert_gauge_count(8)
+        self.assert_gauge(1, call('aws_ec2_count.running.group.count',      1.0, tags=['ac-region:region', 'ac-tag-team:web']))
+        self.assert_gauge(2, call('aws_ec2_count.running.group.footprint',  4.0, tags=['ac-region:region', 'ac-tag-team:web']))
+        self.assert_gauge(3, call('aws_ec2_count.ondemand.group.count',     0.5, tags=['ac-region:region', 'ac-tag-team:web']))
+        self.assert_gauge(4, call('aws_ec2_count.ondemand.group.footprint', 2.0, tags=['ac-region:region', 'ac-tag-team:web']))
+        self.assert_gauge(5, call('aws_ec2_count.running.group.count',      1.0, tags=['ac-region:region', 'ac-tag-team:other']))
+
+    def test_check_group_by_regions(self):
+        # 同じグループでも Region ごとに別のメトリクスになる
+        self.reset_mock()
+
+        def get_running_instances(groups):
+            running = aws_ec2_count.Instances()
+            running.get('region-1a', 'c4', 'large').set_count(1)
+            groups.add('region-1a', 'c4.large', { 'Tags': [ { 'Key': 'team', 'Value': 'web' } ] })
+            return running
+        self.mock_running.side_effect   = get_running_instances
+        self.mock_reserved.return_value = aws_ec2_count.Instances()
+        self.mock_ondemand.return_value = ( aws_ec2_count.Instances(), aws_ec2_count.Instances() )
+
+        counter = aws_ec2_count.AwsEc2Count()
+        for region in [ 'ap-northeast-1', 'us-east-1' ]:
+            counter.check({ 'region': region, 'aggregation_levels': [], 'group_by': [ 'tag:team' ] })
+
+        running = [ c for c in self.mock_gauge.call_args_list if c[0][0] == 'aws_ec2_count.running.group.count' ]
+        self.assertEqual(running, [
+            call('aws_ec2_count.running.group.count', 1.0, tags=['ac-region:ap-northeast-1', 'ac-tag-team:web']),
+            call('aws_ec2_count.running.group.count', 1.0, tags=['ac-region:us-east-1',      'ac-tag-team:web']),
+        ])
+
+    def test_check_all_platforms(self):
+        self.reset_mock()
+        running_inventory = aws_ec2_count.Inventory()
+        running_inventory.get('Linux/UNIX', 'default').get('region-1a', 'c4', 'large').set_count(1)
+        running_inventory.get('Windows', 'dedicated').get('region-1a', 'm4', 'large').set_count(2)
+        reserved_inventory = aws_ec2_count.Inventory()
+        reserved_inventory.get('Windows', 'dedicated').get('region-1a', 'm4', 'large').set_count(1)
+
+        with patch('aws_ec2_count.InstanceFetcher.get_running_inventory') as mock_running_inventory, \
+                patch('aws_ec2_count.InstanceFetcher.get_reserved_inventory') as mock_reserved_inventory:
+            mock_running_inventory.return_value  = running_inventory
+            mock_reserved_inventory.return_value = reserved_inventory
+            self.patcher_ondemand.stop()
+            try:
+                counter = aws_ec2_count.AwsEc2Count()
+                counter.check({ 'region': 'region', 'all_platforms': True })
+            finally:
+                self.patcher_ondemand.start()
+
+        self.mock_running.assert_not_called()
+        self.mock_reserved.assert_not_called()
+        self.assert_log('info',  1, 'reserved ac-platform:Windows ac-tenancy:dedicated')
+        self.assert_log('info',  2, 'region-1a : m4.large = 1.0 (4.0)')
+        self.assert_log('info',  3, 'running ac-platform:Linux/UNIX ac-tenancy:default')
+        self.assert_log('info',  5, 'running ac-platform:Windows ac-tenancy:dedicated')
+        self.assert_log('info',  7, 'ondemand ac-platform:Linux/UNIX ac-tenancy:default')
+        self.assert_log('info',  9, 'ondemand ac-platform:Windows ac-tenancy:dedicated')
+        self.assert_log('info', 10, 'region-1a : m4.large = 1.0 (4.0)')
+
+        self.assert_gauge( 1, call('aws_ec2_count.reserved.count',  1.0, tags=['ac-az:region-1a', 'ac-type:m4.large', 'ac-family:m4', 'ac-platform:Windows', 'ac-tenancy:dedicated']))
+        self.assert_gauge( 9, call('aws_ec2_count.ondemand.count',  1.0, tags=['ac-az:region-1a', 'ac-type:m4.large', 'ac-family:m4', 'ac-platform:Windows', 'ac-tenancy:dedicated']))
+        self.assert_log_count('warning', 0)
+
+    def test_check_all_platforms_unknown(self):
+        self.reset_mock()
+        running_inventory = aws_ec2_count.Inventory()
+        running_inventory.get('Unknown', 'default').get('region-1a', 'c4', 'large').set_count(3)
+
+        with patch('aws_ec2_count.InstanceFetcher.get_running_inventory') as mock_running_inventory, \
+                patch('aws_ec2_count.InstanceFetcher.get_reserved_inventory') as mock_reserved_inventory:
+            mock_running_inventory.return_value  = running_inventory
+            mock_reserved_inventory.return_value = aws_ec2_count.Inventory()
+            self.patcher_ondemand.stop()
+            try:
+                counter = aws_ec2_count.AwsEc2Count()
+                counter.check({ 'region': 'region', 'all_platforms': True })
+            finally:
+                self.patcher_ondemand.start()
+
+        self.assert_log_count('warning', 1)
+        self.assert_log('warning', 1, '3 running instances have no PlatformDetails and are counted as Unknown (boto3 1.18.48 or later is required)')
+        self.assert_gauge( 1, call('aws_ec2_count.running.count',   3.0, tags=['ac-az:region-1a', 'ac-type:c4.large', 'ac-family:c4', 'ac-platform:Unknown', 'ac-tenancy:default']))
+
+    def test_check_circuit_breaker(self):
+        self.reset_mock()
+        self.mock_running.return_value  = aws_ec2_count.Instances()
+        self.mock_reserved.return_value = aws_ec2_count.Instances()
+        self.mock_ondemand.return_value = ( aws_ec2_count.Instances(), aws_ec2_count.Instances() )
+
+        with patch('aws_ec2_count.InstanceFetcher', wraps=aws_ec2_count.InstanceFetcher) as mock_fetcher:
+            counter = aws_ec2_count.AwsEc2Count()
+            for circuit_breaker in [ True, None, {}, False, { 'cooldown': 60 } ]:
+                counter.check({ 'region': 'region', 'circuit_breaker': circuit_breaker })
+            counter.check({ 'region': 'region' })
+
+        self.assertEqual([ c[0][1] for c in mock_fetcher.call_args_list ], [ {}, {}, {}, None, { 'cooldown': 60 }, {} ])
+
+    def test_check_coverage(self):
+        self.reset_mock()
+        self.mock_running.return_value  = aws_ec2_count.Instances()
+        self.mock_reserved.return_value = aws_ec2_count.Instances()
+        ondemand = aws_ec2_count.Instances()
+        ondemand.get('region-1a', 'c4', 'large').set_count(2)
+        self.mock_ondemand.return_value = ( ondemand, aws_ec2_count.Instances() )
+
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({ 'savings_plans': [ { 'family': 'c4', 'footprint': 2.0 } ] }, f)
+            with patch('aws_ec2_count.InstanceFetcher.get_capacity_reservations') as mock_capacity_reservations:
+                mock_capacity_reservations.return_value = [
+                    { 'platform': 'Linux/UNIX', 'tenancy': 'default', 'az': 'region-1a', 'itype': 'c4.large', 'count': 1 },
+                ]
+                counter = aws_ec2_count.AwsEc2Count()
+                counter.check({
+                    'region'          : 'region',
+                    'coverage'        : [ 'capacity_reservation', 'savings_plan' ],
+                    'commitment_file' : path,
+                })
+        finally:
+            os.remove(path)
+
+        self.assert_log('info',  3, 'ondemand')
+        self.assert_log('info',  4, 'region-1a : c4.large = 0.5 (2.0)')
+        self.assert_log('info',  6, 'capacity_reservation_covered')
+        self.assert_log('info',  7, 'region-1a : c4.large = 1.0 (4.0)')
+        self.assert_log('info',  8, 'capacity_reservation_unused')
+        self.assert_log('info',  9, 'ac-az:region-1a,ac-type:c4.large,ac-family:c4 = 0.0 (0.0)')
+        self.assert_log('info', 10, 'savings_plan_covered')
+        self.assert_log('info', 11, 'region-1a : c4.large = 0.5 (2.0)')
+        self.assert_log('info', 12, 'savings_plan_unused')
+        self.assert_log('info', 13, 'ac-family:c4 = (0.0)')
+
+        self.assert_gauge_count(9)
+        self.assert_gauge( 1, call('aws_ec2_count.ondemand.count',                       0.5, tags=['ac-az:region-1a', 'ac-type:c4.large', 'ac-family:c4']))
+        self.assert_gauge( 3, call('aws_ec2_count.capacity_reservation_covered.count',   1.0, tags=['ac-az:region-1a', 'ac-type:c4.large', 'ac-family:c4']))
+        self.assert_gauge( 5, call('aws_ec2_count.capacity_reservation_unused.count',    0.0, tags=['ac-az:region-1a', 'ac-type:c4.large', 'ac-family:c4']))
+        self.assert_gauge( 8, call('aws_ec2_count.savings_plan_covered.footprint',       2.0, tags=['ac-az:region-1a', 'ac-type:c4.large', 'ac-family:c4']))
+        self.assert_gauge( 9, call('aws_ec2_count.savings_plan_unused.footprint',        0.0, tags=['ac-region:region', 'ac-family:c4']))
+
+    def test_check_coverage_shared_commitment_file(self):
+        self.reset_mock()
+        self.mock_running.return_value  = aws_ec2_count.Instances()
+        self.mock_reserved.return_value = aws_ec2_count.Instances()
+        ondemand = aws_ec2_count.Instances()
+        ondemand.get('region-1a', 'c4', 'large').set_count(2)
+        self.mock_ondemand.return_value = ( ondemand, aws_ec2_count.Instances() )
+
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({
+                    'savings_plans' : [
+                        { 'region': 'region', 'family': 'c4', 'footprint': 2.0 },
+                        { 'region': 'other',  'family': 'c4', 'footprint': 10.0 },
+                    ],
+                }, f)
+            counter = aws_ec2_count.AwsEc2Count()
+            for region in [ 'region', 'other' ]:
+                counter.check({
+                    'region'          : region,
+                    'coverage'        : [ 'savings_plan' ],
+                    'commitment_file' : path,
+                })
+        finally:
+            os.remove(path)
+
+        unused = [ c for c in self.mock_gauge.call_args_list if c[0][0] == 'aws_ec2_count.savings_plan_unused.footprint' ]
+        self.assertEqual(unused, [
+            call('aws_ec2_count.savings_plan_unused.footprint', 0.0, tags=['ac-region:region', 'ac-family:c4']),
+            call('aws_ec2_count.savings_plan_unused.footprint', 4.0, tags=['ac-region:other',  'ac-family:c4']),
+        ])
+
+    def test_check_unknown_coverage(self):
+        self.reset_mock()
+        self.mock_running.return_value  = aws_ec2_count.Instances()
+        self.mock_reserved.return_value = aws_ec2_count.Instances()
+        self.mock_ondemand.return_value = ( aws_ec2_count.Instances(), aws_ec2_count.Instances() )
+
+        counter = aws_ec2_count.AwsEc2Count()
+        self.assertRaises(TypeError, counter.check, { 'region': 'region', 'coverage': [ 'invalid' ] })
+
+    def test_check_profiling(self):
+        self.reset_mock()
+        running = aws_ec2_count.Instances()
+        running.get('region-1a', 'c4', 'large').set_count(2)
+        self.mock_running.return_value  = running
+        self.mock_reserved.return_value = aws_ec2_count.Instances()
+        self.mock_ondemand.return_value = ( aws_ec2_count.Instances(), aws_ec2_count.Instances() )
+
+        directory = tempfile.mkdtemp()
+        try:
+            counter = aws_ec2_count.AwsEc2Count()
+            counter.check({ 'region': 'region-profiling', 'profiling': { 'directory': directory } })
+            self.assertEqual(len(os.listdir(directory)), 2)
+        finally:
+            shutil.rmtree(directory)
+
+        self.assert_log_count('info', 7)
+        self.assertTrue(self.get_log('info', 6).startswith('profile : '))
+        self.assertTrue(self.get_log('info', 6).endswith('-n2.prof'))
+        self.assertTrue(self.get_log('info', 7).endswith('-n2.txt'))
+        self.assert_gauge_count(2)
+
+    def test_check_profiling_stages(self):
+        # プロファイルの各段階は、どちらの経路でも送信前の処理だけを計測する
+        self.reset_mock()
+        running = aws_ec2_count.Instances()
+        running.get('region-1a', 'c4', 'large').set_count(2)
+        self.mock_running.return_value  = running
+        self.mock_reserved.return_value = aws_ec2_count.Instances()
+        self.mock_ondemand.return_value = ( aws_ec2_count.Instances(), aws_ec2_count.Instances() )
+
+        marks = []
+
+        def mark(profiler, stage):
+            marks.append(( stage, self.mock_log.info.call_count ))
+
+        directory = tempfile.mkdtemp()
+        try:
+            with patch('aws_ec2_count.CheckProfiler.mark', autospec=True, side_effect=mark), \
+                    patch('aws_ec2_count.InstanceFetcher.get_running_inventory') as mock_running_inventory, \
+                    patch('aws_ec2_count.InstanceFetcher.get_reserved_inventory') as mock_reserved_inventory:
+                mock_running_inventory.return_value  = aws_ec2_count.Inventory()
+                mock_reserved_inventory.return_value = aws_ec2_count.Inventory()
+                counter = aws_ec2_count.AwsEc2Count()
+                for all_platforms in [ False, True ]:
+                    del marks[:]
+                    self.mock_log.reset_mock()
+                    counter.check({ 'region': 'region-stages', 'all_platforms': all_platforms, 'profiling': { 'directory': directory } })
+                    self.assertEqual([ stage for stage, logs in marks ], [ 'reserved', 'running', 'ondemand', 'send' ])
+                    self.assertEqual([ logs for stage, logs in marks ][:3], [ 0, 0, 0 ])
+        finally:
+            shutil.rmtree(directory)
+
+    def test_check_profiling_unwritable(self):
+        self.reset_mock()
+        running = aws_ec2_count.Instances()
+        running.get('region-1a', 'c4', 'large').set_count(2)
+        self.mock_running.return_value  = running
+        self.mock_reserved.return_value = aws_ec2_count.Instances()
+        self.mock_ondemand.return_value = ( aws_ec2_count.Instances(), aws_ec2_count.Instances() )
+
+        directory = tempfile.mkdtemp()
+        try:
+            # ディレクトリを作成できない場合も、計算済みのメトリクスを送信する
+            path = os.path.join(directory, 'file')
+            open(path, 'w').close()
+            counter = aws_ec2_count.AwsEc2Count()
+            counter.check({ 'region': 'region-profiling', 'profiling': { 'directory': os.path.join(path, 'profiles') } })
+        finally:
+            shutil.rmtree(directory)
+
+        self.assert_log_count('warning', 1)
+        self.assertTrue(self.get_log('warning', 1).startswith('failed to write profile : '))
+        self.assert_gauge_count(2)
+        if aws_ec2_count.tracemalloc is not None:
+            self.assertFalse(aws_ec2_count.tracemalloc.is_tracing())
+
+    def test_check_stale(self):
+        self.reset_mock()
+        running = aws_ec2_count.Instances()
+        running.get('region-1a', 'c4', 'large').set_count(1)
+        self.mock_running.return_value  = running
+        self.mock_reserved.return_value = aws_ec2_count.Instances()
+        self.mock_ondemand.return_value = ( aws_ec2_count.Instances(), aws_ec2_count.Instances() )
+
+        counter = aws_ec2_count.AwsEc2Count()
+        with patch('aws_ec2_count.time') as mock_time:
+            mock_time.time.return_value = 1000.0
+            counter.check({ 'region': 'region-stale' })
+            self.assert_gauge_count(2)
+
+            self.reset_mock()
+            self.mock_running.side_effect = aws_ec2_count.CircuitOpenError('circuit open')
+            mock_time.time.return_value = 1090.0
+            counter.check({ 'region': 'region-stale' })
+
+        self.assert_log_count('warning', 1)
+        self.assert_log('warning', 1, 'send stale metrics computed 90s ago : circuit open')
+        self.assert_gauge_count(3)
+        self.assert_gauge(1, call('aws_ec2_count.running.count',     1.0, tags=['ac-az:region-1a', 'ac-type:c4.large', 'ac-family:c4', 'ac-stale:true']))
+        self.assert_gauge(2, call('aws_ec2_count.running.footprint', 4.0, tags=['ac-az:region-1a', 'ac-type:c4.large', 'ac-family:c4', 'ac-stale:true']))
+        self.assert_gauge(3, call('aws_ec2_count.stale_age',        90.0, tags=['ac-region:region-stale']))
+
+        # 正常に計算できたメトリクスがない場合は例外をそのまま投げる
+        self.reset_mock()
+        self.assertRaises(aws_ec2_count.CircuitOpenError, counter.check, { 'region': 'region-stale', 'max_az_series': 1 })
+        self.assert_gauge_count(0)
+
+    def test_check_dogstatsd(self):
+        self.reset_mock()
+        running = aws_ec2_count.Instances()
+        running.get('region-1a', 'c4', 'large').set_count(1)
+        self.mock_running.return_value  = running
+        self.mock_reserved.return_value = aws_ec2_count.Instances()
+        self.mock_ondemand.return_value = ( aws_ec2_count.Instances(), aws_ec2_count.Instances() )
+
+        listeners = []
+        for i in range(2):
+            listener = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            listener.bind(('127.0.0.1', 0))
+            listener.settimeout(5)
+            listeners.append(listener)
+        try:
+            counter = aws_ec2_count.AwsEc2Count()
+            counter.check({
+                'region'    : 'region-dogstatsd',
+                'dogstatsd' : [ { 'port': sock.getsockname()[1] } for sock in listeners ],
+            })
+            for listener in listeners:
+                self.assertEqual(listener.recv(65535), (
+                    b'aws_ec2_count.running.count:1.0|g|#ac-az:region-1a,ac-type:c4.large,ac-family:c4\n'
+                    b'aws_ec2_count.running.footprint:4.0|g|#ac-az:region-1a,ac-type:c4.large,ac-family:c4'
+                ))
+        finally:
+            for listener in listeners:
+                listener.close()
+
+        self.assert_gauge_count(0)
+
+
+class TestMetricsExporter(unittest.TestCase):
+    def setUp(self):
+        self.patcher_running  = patch('aws_ec2_count.InstanceFetcher.get_running_instances')
+        self.mock_running = self.patcher_running.start()
+        self.patcher_reserved = patch('aws_ec2_count.InstanceFetcher.get_reserved_instances')
+        self.mock_reserved = self.patcher_reserved.start()
+        self.patcher_ondemand = patch('aws_ec2_count.InstanceFetcher.get_ondemand_instances')
+        self.mock_ondemand = self.patcher_ondemand.start()
+        self.patcher_session = patch('aws_ec2_count.Session')
+        self.patcher_session.start()
+
+        running = aws_ec2_count.Instances()
+        running.get('region-1a', 'c4', 'large').set_count(2)
+        self.mock_running.return_value  = running
+        self.mock_reserved.return_value = aws_ec2_count.Instances()
+        self.mock_ondemand.return_value = ( aws_ec2_count.Instances(), aws_ec2_count.Instances() )
+
+    def tearDown(self):
+        self.patcher_running.stop()
+        self.patcher_reserved.stop()
+        self.patcher_ondemand.stop()
+        self.patcher_session.stop()
+
+    def test_render(self):
+        self.assertEqual(aws_ec2_count.MetricsExporter.render([]), b'\n')
+        self.assertEqual(aws_ec2_count.MetricsExporter.render([
+            ('aws_ec2_count.running.count', 2,   ['ac-az:region-1a', 'ac-type:c4.large']),
+            ('aws_ec2_count.stale_age',     1.5, []),
+            ('aws_ec2_count.running.count', 3,   ['ac-az:region-1b', 'ac-tag-team:a"b']),
+        ]), (
+            '# TYPE aws_ec2_count_running_count gauge\n'
+            'aws_ec2_count_running_count{ac_az="region-1a",ac_type="c4.large"} 2.0\n'
+            'aws_ec2_count_running_count{ac_az="region-1b",ac_tag_team="a\\"b"} 3.0\n'
+            '# TYPE aws_ec2_count_stale_age gauge\n'
+            'aws_ec2_count_stale_age{} 1.5\n'
+        ).encode('utf-8'))
+
+    def test_render_duplicate(self):
+        # 同じラベルの sample は最初のものだけを返す
+        log = Mock()
+        self.assertEqual(aws_ec2_count.MetricsExporter.render([
+            ('aws_ec2_count.running.count', 2, ['ac-az:region', 'ac-type:c4.large']),
+            ('aws_ec2_count.running.count', 3, ['ac-az:region', 'ac-type:c4.large']),
+        ], log), (
+            '# TYPE aws_ec2_count_running_count gauge\n'
+            'aws_ec2_count_running_count{ac_az="region",ac_type="c4.large"} 2.0\n'
+        ).encode('utf-8'))
+        self.assertEqual(log.warning.call_count, 1)
+
+    def test_refresh(self):
+        exporter = aws_ec2_count.MetricsExporter(
+            { 'metrics_prefix': 'exporter' },
+            [ { 'region': 'region-exporter' }, {} ],
+            Mock(),
+        )
+        self.assertEqual(exporter.get_body(), b'')
+        body = exporter.refresh()
+        self.assertTrue(exporter.get_body() is body)
+        self.assertEqual(body, (
+            '# TYPE exporter_running_count gauge\n'
+            'exporter_running_count{ac_az="region-1a",ac_type="c4.large",ac_family="c4",ac_region="region-exporter"} 2.0\n'
+            '# TYPE exporter_running_footprint gauge\n'
+            'exporter_running_footprint{ac_az="region-1a",ac_type="c4.large",ac_family="c4",ac_region="region-exporter"} 8.0\n'
+        ).encode('utf-8'))
+
+        # Region 指定 RI ( ac-az:region ) も Region ごとに別の sample になる
+        reserved = aws_ec2_count.Instances()
+        reserved.get('region', 'c4', 'large').set_count(1)
+        self.mock_running.return_value  = aws_ec2_count.Instances()
+        self.mock_reserved.return_value = reserved
+        exporter = aws_ec2_count.MetricsExporter({}, [ { 'region': 'region-exporter-a' }, { 'region': 'region-exporter-b' } ], Mock())
+        body = exporter.refresh().decode('utf-8')
+        self.assertTrue('aws_ec2_count_reserved_count{ac_az="region",ac_type="c4.large",ac_family="c4",ac_region="region-exporter-a"} 1.0\n' in body)
+        self.assertTrue('aws_ec2_count_reserved_count{ac_az="region",ac_type="c4.large",ac_family="c4",ac_region="region-exporter-b"} 1.0\n' in body)
+        self.assertEqual(exporter.log.warning.call_count, 0)
+
+        # 失敗したチェックがあっても他のチェックの結果は返す
+        self.mock_running.side_effect = Exception('Throttling')
+        exporter = aws_ec2_count.MetricsExporter({}, [ { 'region': 'region-exporter-error' } ], Mock())
+        self.assertEqual(exporter.refresh(), b'\n')
+        self.assertEqual(exporter.log.exception.call_count, 1)
+
+    def test_serve(self):
+        try:
+            from urllib.request import urlopen
+            from urllib.error import HTTPError
+        except ImportError:
+            from urllib2 import urlopen
+            from urllib2 import HTTPError
+
+        exporter = aws_ec2_count.MetricsExporter({}, [ { 'region': 'region-serve' } ], Mock())
+        exporter.refresh()
+        server = exporter.serve('127.0.0.1', 0)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.start()
+        try:
+            url = 'http://127.0.0.1:{}'.format(server.server_address[1])
+            response = urlopen(url + '/metrics')
+            self.assertEqual(response.read(), exporter.get_body())
+            self.assertEqual(self.mock_running.call_count, 1)
+            self.assertRaises(HTTPError, urlopen, url + '/')
+        finally:
+            server.shutdown()
+            server.server_close()
+            thread.join()
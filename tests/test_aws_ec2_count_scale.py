@@ -0,0 +1,211 @@
+# -*- coding: utf-8 -*-
+import random
+import time
+import unittest
+from mock import patch
+
+import aws_ec2_count
+
+try:
+    import tracemalloc
+except ImportError:
+    # tracemalloc is available in Python 3.4 or later
+    tracemalloc = None
+
+
+SIZES = list(aws_ec2_count.NormalizationFactor.get_sorted_all_sizes())
+
+
+class FleetGenerator():
+    def __init__(self, seed, azs, families, sizes=None):
+        self.random   = random.Random(seed)
+        self.azs      = [ 'region-{}'.format(i) for i in range(azs) ]
+        self.families = [ 'f{}'.format(i) for i in range(families) ]
+        self.sizes    = sizes if sizes is not None else SIZES
+
+    def itype(self):
+        return '{}.{}'.format(self.random.choice(self.families), self.random.choice(self.sizes))
+
+    def running_instances(self, count):
+        instances = []
+        for i in range(count):
+            instances.append({
+                'Placement'    : { 'AvailabilityZone' : self.random.choice(self.azs) },
+                'InstanceType' : self.itype(),
+            })
+        return instances
+
+    def reserved_instances(self, count):
+        reserved_instances = []
+        for i in range(count):
+            reserved_instance = {
+                'ReservedInstancesId' : i,
+                'Scope'               : 'Region',
+                'InstanceType'        : self.itype(),
+                'InstanceCount'       : self.random.randint(1, 20),
+            }
+            if self.random.random() < 0.5:
+                reserved_instance['Scope']            = 'Availability Zone'
+                reserved_instance['AvailabilityZone'] = self.random.choice(self.azs)
+            reserved_instances.append(reserved_instance)
+        return reserved_instances
+
+    def instances(self, cells, max_count):
+        instances = aws_ec2_count.Instances()
+        for i in range(cells):
+            family, size = self.itype().split('.', 1)
+            instances.get(self.random.choice(self.azs + [ 'region' ]), family, size).add_count(self.random.randint(1, max_count))
+        return instances
+
+
+class StubEc2Client():
+    # MEMO: Mock は呼び出しを全て記録するため、大規模なテストではメモリ使用量の計測を歪めないよう使わない
+    def __init__(self, running_instances, reserved_instances, page_size=100):
+        self.running_instances  = running_instances
+        self.reserved_instances = reserved_instances
+        self.page_size          = page_size
+
+    def describe_instances(self, Filters, MaxResults, NextToken):
+        start = int(NextToken or 0)
+        end   = start + self.page_size
+        page  = { 'Reservations' : [ { 'Instances' : self.running_instances[start:end] } ] }
+        if end < len(self.running_instances):
+            page['NextToken'] = str(end)
+        return page
+
+    def describe_reserved_instances(self, Filters):
+        return { 'ReservedInstances' : self.reserved_instances }
+
+    def describe_reserved_instances_modifications(self, Filters):
+        return { 'ReservedInstancesModifications' : [] }
+
+
+class InvariantsMixin():
+    def assert_close(self, first, second, msg=None):
+        self.assertTrue(abs(first - second) <= 1e-6 * max(1.0, abs(first), abs(second)), '{} != {} : {}'.format(first, second, msg))
+
+    def assert_invariants(self, running, reserved, ondemand, unused, size_flexible=True):
+        running_cells  = dict(((i['az'], i['itype']), i) for i in running.dump())
+        reserved_cells = dict(((i['az'], i['itype']), i) for i in reserved.dump())
+        ondemand_cells = dict(((i['az'], i['itype']), i) for i in ondemand.dump())
+        unused_cells   = dict(((i['az'], i['itype']), i) for i in unused.dump())
+
+        # オンデマンドは稼働中のインスタンスと同じ単位で、0 以上かつ稼働数以下になる
+        self.assertEqual(set(ondemand_cells.keys()), set(running_cells.keys()))
+        for key, instance in ondemand_cells.items():
+            self.assertTrue(instance['count'] >= -1e-9, key)
+            self.assertTrue(instance['count'] <= running_cells[key]['count'] + 1e-9, key)
+
+        # 余剰 RI は契約中の RI の範囲内で 0 以上になる
+        for key, instance in unused_cells.items():
+            self.assertTrue(key in reserved_cells, key)
+            self.assertTrue(instance['count'] >= -1e-9, key)
+            self.assertTrue(instance['count'] <= reserved_cells[key]['count'] + 1e-9, key)
+
+        # Instance Family ごとに footprint 値が保存される ( Region 指定 RI が他の Family に適用されない)
+        # 稼働中の footprint - オンデマンドの footprint = 適用された RI の footprint
+        # ( 稼働中のインスタンスがない AZ 指定 RI は余剰 RI に含まれないため除く)
+        group = ( lambda instance: instance['family'] ) if size_flexible else ( lambda instance: instance['itype'] )
+        applied = {}
+        for key, instance in running_cells.items():
+            applied[group(instance)] = applied.get(group(instance), 0.0) + instance['footprint']
+        for key, instance in ondemand_cells.items():
+            applied[group(instance)] -= instance['footprint']
+
+        used = {}
+        for key, instance in reserved_cells.items():
+            if key[0] != 'region' and key not in running_cells:
+                continue
+            used[group(instance)] = used.get(group(instance), 0.0) + instance['footprint']
+        for key, instance in unused_cells.items():
+            used[group(instance)] -= instance['footprint']
+
+        for name in set(applied.keys()) | set(used.keys()):
+            self.assert_close(applied.get(name, 0.0), used.get(name, 0.0), name)
+
+
+class TestAllocationProperties(unittest.TestCase, InvariantsMixin):
+    def setUp(self):
+        self.patcher_session = patch('aws_ec2_count.Session')
+        self.patcher_session.start()
+        self.fetcher = aws_ec2_count.InstanceFetcher('region')
+
+    def tearDown(self):
+        self.patcher_session.stop()
+
+    def test_random_fleets(self):
+        for seed in range(300):
+            generator = FleetGenerator(seed, azs=3, families=3, sizes=SIZES[:6])
+            running   = self.__without_region(generator.instances(generator.random.randint(0, 30), 10))
+            reserved  = generator.instances(generator.random.randint(0, 20), 10)
+            for size_flexible in [ True, False ]:
+                ondemand, unused = self.fetcher.get_ondemand_instances(running, reserved, size_flexible=size_flexible)
+                self.assert_invariants(running, reserved, ondemand, unused, size_flexible)
+
+    def test_random_inventories(self):
+        for seed in range(100):
+            generator = FleetGenerator(seed, azs=2, families=2, sizes=SIZES[:4])
+            running_inventory  = aws_ec2_count.Inventory()
+            reserved_inventory = aws_ec2_count.Inventory()
+            for bucket in [ ('Linux/UNIX', 'default'), ('Linux/UNIX', 'dedicated'), ('Windows', 'default') ]:
+                running_inventory.set(bucket[0], bucket[1], self.__without_region(generator.instances(10, 5)))
+                reserved_inventory.set(bucket[0], bucket[1], generator.instances(5, 5))
+
+            ondemand_inventory, unused_inventory = self.fetcher.get_ondemand_inventory(running_inventory, reserved_inventory)
+            for bucket in running_inventory.get_all_buckets():
+                self.assert_invariants(
+                    running_inventory.get(*bucket),
+                    reserved_inventory.get(*bucket),
+                    ondemand_inventory.get(*bucket),
+                    unused_inventory.get(*bucket),
+                    aws_ec2_count.Platform.is_size_flexible(*bucket),
+                )
+
+    def __without_region(self, instances):
+        # 稼働中のインスタンスに 'region' は存在しない
+        result = aws_ec2_count.Instances()
+        for instance in instances.get_all_instances():
+            if instance['az'] != 'region':
+                result.get(instance['az'], instance['family'], instance['size']).set_count(instance['counter'].get_count())
+        return result
+
+
+class TestScale(unittest.TestCase, InvariantsMixin):
+    # ( AZ 数, Instance Family 数, 稼働インスタンス数, RI 数, 制限時間(秒), メモリ使用量の上限(MB) )
+    SCALES = [
+        (  5,  10,   1000,    100,  2.0,  10 ),
+        ( 20,  50,  20000,   2000,  8.0,  30 ),
+        ( 50, 100, 100000,  10000, 25.0, 100 ),
+    ]
+
+    def test_scale(self):
+        for azs, families, instances, reserved_instances, seconds, megabytes in self.SCALES:
+            generator = FleetGenerator(azs * families, azs, families)
+            client = StubEc2Client(generator.running_instances(instances), generator.reserved_instances(reserved_instances))
+
+            with patch('aws_ec2_count.Session') as mock_session:
+                mock_session.return_value.client.return_value = client
+                if tracemalloc is not None:
+                    tracemalloc.start()
+                started_at = time.time()
+
+                fetcher  = aws_ec2_count.InstanceFetcher('region')
+                running  = fetcher.get_running_instances()
+                reserved = fetcher.get_reserved_instances()
+                ondemand, unused = fetcher.get_ondemand_instances(running, reserved)
+                ondemand.dump()
+                unused.dump()
+
+                elapsed = time.time() - started_at
+                peak = None
+                if tracemalloc is not None:
+                    peak = tracemalloc.get_traced_memory()[1] / 1024.0 / 1024.0
+                    tracemalloc.stop()
+
+            scale = '{} azs, {} families, {} instances'.format(azs, families, instances)
+            self.assertTrue(elapsed <= seconds, '{} : {:.2f}s > {}s'.format(scale, elapsed, seconds))
+            if peak is not None:
+                self.assertTrue(peak <= megabytes, '{} : {:.1f}MB > {}MB'.format(scale, peak, megabytes))
+
+            self.assert_close(running.rollup()[1]['count'], instances)
+            self.assert_invariants(running, reserved, ondemand, unused)